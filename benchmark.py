@@ -0,0 +1,251 @@
+'''Benchmarks the analyzer on synthetic settlements.
+
+Generates flat file (v2) settlements with every amount-description the analyzer knows about, plus a matching
+FBA archive, storage, LTS, advertising and cost report, then times (and optionally memory-profiles) each stage
+at several sizes. Results are written as JSON so runs before and after a change can be compared:
+
+    python benchmark.py --rows 10000 100000 1000000 --output bench_before.json
+    python benchmark.py --rows 10000 100000 1000000 --output bench_after.json --compare bench_before.json
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import main
+
+flat_file_columns = list(main.dtypes)
+
+#share of order item rows by amount-description
+order_descriptions = {'Principal': 1.0, 'Tax': 0.6, 'Commission': 1.0, 'FBAPerUnitFulfillmentFee': 0.85,
+    'FBAPerOrderFulfillmentFee': 0.03, 'FBAWeightBasedFee': 0.03, 'VariableClosingFee': 0.05, 'Shipping': 0.05,
+    'ShippingChargeback': 0.05, 'ShippingHB': 0.01, 'Goodwill': 0.002}
+refund_descriptions = {'Principal': 1.0, 'Commission': 1.0, 'RefundCommission': 1.0, 'RestockingFee': 0.1}
+#per-SKU adjustments (other-transaction rows with a SKU and quantity)
+adjustment_descriptions = ['FREE_REPLACEMENT_REFUND_ITEMS', 'REVERSAL_REIMBURSEMENT', 'WAREHOUSE_DAMAGE',
+    'WAREHOUSE_DAMAGE_EXCEPTION', 'WAREHOUSE_LOST', 'WAREHOUSE_LOST_MANUAL', 'CS_ERROR_ITEMS',
+    'MISSING_FROM_INBOUND', 'COMPENSATED_CLAWBACK']
+#account level rows without a SKU
+account_descriptions = main.non_sku_descriptions + ['Storage Fee']
+
+def make_skus(sku_count):
+    families = np.array(['NIRO', 'HD', 'MD', 'MED', 'GEN'])
+    return np.array([families[i % len(families)] + '-' + str(i).zfill(5) for i in range(sku_count)])
+
+def generate_rows(rng, rows, skus, mfn_share, settlement_id, first_order):
+    '''Returns about `rows` flat file rows (order items, refunds and adjustments) as a dataframe of strings'''
+    rows_per_item = sum(order_descriptions.values())
+    items = max(1, int(rows * 0.92 / rows_per_item))
+    refunds = max(1, int(items * 0.04))
+    adjustments = max(1, rows - int(items * rows_per_item) - int(refunds * sum(refund_descriptions.values())))
+    item_skus = rng.choice(skus, items, p=sku_weights(len(skus)))
+    item_orders = first_order + np.arange(items) // 2
+    quantities = rng.choice([1, 1, 1, 2, 3], items)
+    prices = np.round(rng.uniform(8, 60, len(skus)), 2)
+    price = prices[np.searchsorted(skus, item_skus)] * quantities
+    fulfillment = np.where(rng.random(items) < mfn_share, 'MFN', 'AFN')
+    days = rng.integers(1, 15, items)
+    frames = []
+    for description, share in order_descriptions.items():
+        picked = rng.random(items) < share
+        amount = {'Principal': price, 'Tax': price * 0.07, 'Commission': price * -0.15,
+            'FBAPerUnitFulfillmentFee': -3.2 * quantities}.get(description, rng.uniform(-4, 4, items))
+        frames.append(item_frame(picked, 'Order', description, item_skus, item_orders, quantities, amount, fulfillment, days, None))
+    refunded = rng.choice(items, refunds, replace=False)
+    refund_mask = np.zeros(items, dtype=bool)
+    refund_mask[refunded] = True
+    for description, share in refund_descriptions.items():
+        picked = refund_mask & (rng.random(items) < share)
+        amount = {'Principal': -price, 'Commission': price * 0.15, 'RefundCommission': price * -0.03}.get(description, rng.uniform(-5, 0, items))
+        frames.append(item_frame(picked, 'Refund', description, item_skus, item_orders, quantities, amount, fulfillment, days,
+            np.char.add('amzn1.adj.', np.arange(items).astype(str))))
+    adjustment_skus = rng.choice(skus, adjustments)
+    frames.append(pd.DataFrame({
+        'transaction-type': 'other-transaction',
+        'amount-type': 'FBA Inventory Reimbursement',
+        'amount-description': rng.choice(adjustment_descriptions, adjustments),
+        'amount': np.round(rng.uniform(-10, 30, adjustments), 2).astype(str),
+        'sku': adjustment_skus,
+        'quantity-purchased': rng.integers(1, 3, adjustments).astype(str),
+        'posted-date': date_strings(rng.integers(1, 15, adjustments)),
+        'adjustment-id': np.char.add('amzn1.inv.', np.arange(adjustments).astype(str)),
+    }))
+    settlement_rows = pd.concat(frames, ignore_index=True)
+    settlement_rows = settlement_rows.iloc[rng.permutation(len(settlement_rows))]
+    settlement_rows['settlement-id'] = settlement_id
+    settlement_rows['marketplace-name'] = 'Amazon.com'
+    settlement_rows['posted-date-time'] = settlement_rows['posted-date'] + ' 10:00:00 UTC'
+    return settlement_rows.reindex(columns=flat_file_columns)
+
+def sku_weights(sku_count):
+    '''Long tail of sales: a few SKUs sell most units'''
+    weights = 1 / np.arange(1, sku_count + 1) ** 0.8
+    return weights / weights.sum()
+
+def date_strings(days):
+    return np.char.add('2023-03-', np.char.zfill(days.astype(str), 2))
+
+def item_frame(picked, transaction_type, description, skus, orders, quantities, amounts, fulfillment, days, adjustment_ids):
+    order_ids = np.char.add('111-', np.char.zfill(orders[picked].astype(str), 7))
+    frame = pd.DataFrame({
+        'transaction-type': transaction_type,
+        'order-id': order_ids,
+        'merchant-order-id': order_ids,
+        'shipment-id': np.char.add('S', orders[picked].astype(str)),
+        'amount-type': 'ItemPrice' if description in ('Principal', 'Tax', 'Shipping') else 'ItemFees',
+        'amount-description': description,
+        'amount': np.round(np.broadcast_to(amounts, picked.shape)[picked], 2).astype(str),
+        'fulfillment-id': fulfillment[picked],
+        'posted-date': date_strings(days[picked]),
+        'order-item-code': np.char.add('5', orders[picked].astype(str)),
+        'sku': skus[picked],
+        'quantity-purchased': np.where(description == 'Principal', quantities[picked].astype(str), ''),
+    })
+    if adjustment_ids is not None:
+        frame['adjustment-id'] = adjustment_ids[picked]
+    return frame
+
+def generate_settlement(path, rows, sku_count=2000, mfn_share=0.05, seed=0, settlement_id='12345678901', block_rows=1000000):
+    '''Writes a synthetic flat file (v2) of about `rows` rows, in blocks so 10M+ row files fit in memory. Returns the SKUs used'''
+    rng = np.random.default_rng(seed)
+    skus = np.sort(make_skus(sku_count))
+    header = pd.DataFrame([dict.fromkeys(flat_file_columns, '')])
+    header.loc[0, ['settlement-id', 'settlement-start-date', 'settlement-end-date', 'deposit-date', 'total-amount', 'currency']] = [
+        settlement_id, '2023-03-01 00:00:00 UTC', '2023-03-15 00:00:00 UTC', '2023-03-17 00:00:00 UTC', '123456.78', 'USD']
+    header.to_csv(path, sep='\t', index=False)
+    written = 0
+    while written < rows:
+        block = min(block_rows, rows - written)
+        generate_rows(rng, block, skus, mfn_share, settlement_id, written).to_csv(path, sep='\t', index=False, header=False, mode='a')
+        written += block
+    account_rows = pd.DataFrame({'settlement-id': settlement_id, 'transaction-type': 'other-transaction',
+        'amount-description': account_descriptions, 'amount': np.round(rng.uniform(-200, 50, len(account_descriptions)), 2).astype(str)})
+    account_rows.reindex(columns=flat_file_columns).to_csv(path, sep='\t', index=False, header=False, mode='a')
+    return skus
+
+def generate_auxiliary_reports(folder, skus, seed=0):
+    '''Writes an FBA archive, monthly storage, LTS, advertising and cost report matching the SKUs. Returns their paths'''
+    rng = np.random.default_rng(seed + 1)
+    fnskus = np.char.add('X00', np.char.zfill(np.arange(len(skus)).astype(str), 7))
+    paths = {name: os.path.join(folder, name + extension) for name, extension in
+        [('fba_archive', '.csv'), ('storage', '.csv'), ('lts', '.csv'), ('advertising', '.xlsx'), ('cost', '.csv')]}
+    pd.DataFrame({'sku': skus, 'fnsku': fnskus, 'asin': np.char.add('B0', np.char.zfill(np.arange(len(skus)).astype(str), 8)),
+        'product-name': np.char.add('Synthetic product ', skus), 'condition': 'New'}).to_csv(paths['fba_archive'], index=False)
+    pd.DataFrame({'fnsku': fnskus, 'asin': 'B0', 'month_of_charge': '2023-02',
+        'estimated_monthly_storage_fee': np.round(rng.uniform(0, 8, len(skus)), 4)}).to_csv(paths['storage'], index=False)
+    charged = rng.random(len(skus)) < 0.1
+    pd.DataFrame({'snapshot-date': '2023-02-15', 'sku': skus[charged], 'fnsku': fnskus[charged],
+        'amount-charged': np.round(rng.uniform(0, 20, charged.sum()), 2)}).to_csv(paths['lts'], index=False)
+    advertised = rng.random(len(skus)) < 0.4
+    try:
+        pd.DataFrame({'Advertised SKU': skus[advertised], 'Spend': np.round(rng.uniform(0, 150, advertised.sum()), 2)}).to_excel(paths['advertising'], index=False)
+    except ImportError:
+        #no Excel writer installed (openpyxl), skip the advertising stages
+        paths['advertising'] = None
+    pd.DataFrame({'SKU': skus, 'PRODUCT COST': np.round(rng.uniform(1, 15, len(skus)), 2),
+        'SHIPPING COST': np.round(rng.uniform(0, 2, len(skus)), 2)}).to_csv(paths['cost'], index=False)
+    return paths
+
+def measure(function, memory):
+    '''Runs function once. Returns its result, seconds taken and (with memory) peak bytes allocated'''
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def benchmark_stages(flat_file, paths, output_prefix, memory=False):
+    '''Times every stage of one run. Returns a list of {stage, seconds, peak_bytes}'''
+    results = []
+    def stage(name, function):
+        result, seconds, peak = measure(function, memory)
+        results.append({'stage': name, 'seconds': round(seconds, 6), 'peak_bytes': peak})
+        return result
+    settlement_df = stage('parse settlement', lambda: main.read_settlement(flat_file))
+    archive_df = stage('parse fba archive', lambda: pd.read_csv(paths['fba_archive'], encoding='latin1'))
+    storage_df = stage('parse storage', lambda: pd.read_csv(paths['storage'], encoding='latin1'))
+    lts_df = stage('parse lts', lambda: pd.read_csv(paths['lts'], encoding='latin1'))
+    advertising_df = stage('parse advertising', lambda: pd.read_excel(paths['advertising'])) if paths['advertising'] else None
+    cost_df = stage('parse cost', lambda: pd.read_csv(paths['cost']))
+    for helper in ['get_units_sold', 'get_nonsales_units', 'get_merchantfulfilled_units', 'get_salesbased_revenue',
+            'get_average_sales_price', 'get_commission', 'get_average_commision_per_unit', 'get_commission_percent',
+            'get_fba_fees', 'get_average_fba_fees', 'get_nonsales_revenue', 'get_non_skus',
+            'get_sku_metrics', 'get_description_totals', 'get_statement_period']:
+        stage(helper, lambda: getattr(main, helper)(settlement_df))
+    inventory = stage('index fba archive', lambda: main.as_inventory_index(archive_df))
+    asins_and_skus_df = stage('get_asin_and_title', lambda: main.get_asin_and_title(inventory))
+    storage_sku_df = stage('get_storage_with_sku', lambda: main.get_storage_with_sku(storage_df, inventory))
+    lts_sku_df = stage('get_lts_with_sku', lambda: main.get_lts_with_sku(lts_df, inventory))
+    advertising_spend = stage('get_advertising_spend', lambda: main.get_advertising_spend(advertising_df)) if advertising_df is not None else None
+    product_cost_df = stage('get_cost', lambda: main.get_cost(cost_df))
+    main_df = stage('main_table', lambda: main.main_table(settlement_df, asins_and_skus_df, storage_sku_df, lts_sku_df, advertising_spend, product_cost_df))
+    overview_df = stage('get_overview', lambda: main.get_overview(settlement_df, main_df, storage_sku_df, advertising_spend))
+    period = main.get_statement_period(settlement_df)
+    stage('export_report', lambda: main.export_report(output_prefix, period, {'Sales': main_df, 'Overview': overview_df}))
+    stage('read_settlement_summary (streaming)', lambda: main.read_settlement_summary(flat_file))
+    return results
+
+def run_benchmarks(row_counts, sku_count, mfn_share, memory, seed, folder):
+    runs = []
+    for rows in row_counts:
+        flat_file = os.path.join(folder, 'settlement_' + str(rows) + '.txt')
+        start = time.perf_counter()
+        skus = generate_settlement(flat_file, rows, sku_count, mfn_share, seed)
+        paths = generate_auxiliary_reports(folder, skus, seed)
+        print('generated ' + str(rows) + ' rows in ' + format(time.perf_counter() - start, '.1f') + 's')
+        stages = benchmark_stages(flat_file, paths, os.path.join(folder, 'report_' + str(rows)), memory)
+        runs.append({'rows': rows, 'file_bytes': os.path.getsize(flat_file), 'skus': sku_count, 'stages': stages})
+        for result in stages:
+            peak = '' if result['peak_bytes'] is None else format(result['peak_bytes'] / 2 ** 20, '10.1f') + ' MiB'
+            print(format(rows, '>10') + '  ' + format(result['stage'], '<38') + format(result['seconds'], '10.4f') + 's ' + peak)
+    return runs
+
+def compare_runs(current, baseline):
+    '''Prints the change in seconds of every stage against an earlier results file'''
+    before = {(run['rows'], stage['stage']): stage['seconds'] for run in baseline['runs'] for stage in run['stages']}
+    for run in current['runs']:
+        for stage in run['stages']:
+            key = (run['rows'], stage['stage'])
+            if key in before and before[key] > 0:
+                change = stage['seconds'] / before[key] - 1
+                print(format(run['rows'], '>10') + '  ' + format(stage['stage'], '<38') + format(change, '+8.1%'))
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the settlement analyzer on synthetic settlements')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='settlement sizes to run (up to 10M+)')
+    parser.add_argument('--skus', type=int, default=2000, help='number of distinct SKUs')
+    parser.add_argument('--mfn-share', type=float, default=0.05, help='share of merchant fulfilled order items')
+    parser.add_argument('--memory', action='store_true', help='also record peak allocations per stage (tracemalloc, slower)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folder', help='where to write the synthetic files (default: a temporary folder)')
+    parser.add_argument('--output', default='bench_output.json', help='results file')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as temporary:
+        folder = args.folder or temporary
+        os.makedirs(folder, exist_ok=True)
+        runs = run_benchmarks(args.rows, args.skus, args.mfn_share, args.memory, args.seed, folder)
+    results = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+        'machine': platform.machine(), 'runs': runs}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('results written to ' + args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare_runs(results, json.load(f))
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,247 @@
+'''Headless entry point for the settlement analyzer.
+
+Single settlement:
+    python cli.py --flat-file settlement.txt --fba-archive archive.csv --output report
+
+Batch (every flat file in a folder, spread across processes):
+    python cli.py --batch settlements/ --fba-archive archive.csv --output reports/
+
+Rollups (settlements saved with --rollup-store, summed by month, quarter or year):
+    python cli.py --rollup month --rollup-store rollups/ --output monthly
+
+Watch a folder (reports for each new flat file, matched with the archive, storage, LTS and advertising reports there):
+    python cli.py --watch downloads/ --output reports/
+
+Accounts (rows split by account, marketplace and currency, see partitions.py for the accounts file):
+    python cli.py --accounts accounts.json --output combined
+
+Trends (units, revenue, fee and return per unit of each SKU by posted day or week, with rolling windows):
+    python cli.py --trends settlements/ --trend-period week --output trends
+
+What-if (a settlement saved in the rollup store under price, cost and advertising scenarios, without re-reading it):
+    python cli.py --what-if 12345678 --rollup-store rollups/ --scenarios scenarios.json --output what_if
+
+Inspect (settlement-id, period, currency, row counts and storage/subscription charges, without a report):
+    python cli.py --inspect settlement.txt
+'''
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import profiling
+from drilldown import drilldown_tabs, index_settlement, load_drilldown, report_columns
+from fees import get_fee_alerts
+from main import export_report, find_flat_files, inspect_settlement, load_and_analyze, parse_settlement_date, schema_memory_report
+from partitions import load_accounts, run_accounts
+from report_writer import output_formats, write_report
+from rollup import export_rollup, load_settlement, save_settlement
+from scenarios import load_scenarios, scenario_tabs
+from trends import export_trends, trend_table
+from watcher import watch
+
+def report_kwargs(args):
+    '''Returns the optional reports and settings given on the command line, as process_settlement keyword arguments'''
+    return {
+        'storage_report': args.storage,
+        'lts_report': args.lts,
+        'advertising_report': args.advertising,
+        'helium10': args.cost,
+        'invoiced_file': args.invoiced,
+        'chunksize': args.chunksize,
+        'sku_families': args.sku_families,
+        'formats': args.format,
+        'drilldown': args.drilldown,
+        'threads': args.threads,
+        'fee_alerts': args.rollup_store if args.fee_alerts else None,
+        'scenarios': args.scenarios,
+    }
+
+def add_fee_alerts(store, result):
+    '''Adds the Fee Alerts tab of a processed settlement, checked against the fee history of a rollup store'''
+    with profiling.stage('fee alerts'):
+        result['tabs']['Fee Alerts'] = get_fee_alerts(store, result['settlement_id'], result['statement_period'], result['tabs']['Sales'])
+
+def process_settlement(flat_file, fba_inventory_report, output_prefix, formats=('xlsx',), drilldown=None, fee_alerts=None, scenarios=None, export=True, **kwargs):
+    '''Analyzes and exports one settlement. Returns the files written with what the rollup store needs.
+    drilldown is a list of SKUs (possibly empty) to add the drilldown tabs for. fee_alerts is a rollup store
+    whose fee history the settlement's fees are checked against, adding a Fee Alerts tab. scenarios is a scenarios
+    file (see scenarios.py), adding the Scenarios and Scenario Profit tabs. With export=False the tabs are
+    returned without being written.
+    When profiling, the stages of this settlement are written to <output_prefix>_profile.json'''
+    profiling.reset()
+    with profiling.stage('process_settlement'):
+        #the drilldown rows come from the report's own read of the flat file
+        summary, tabs = load_and_analyze(flat_file, fba_inventory_report, columns=report_columns if drilldown is not None else None, **kwargs)
+        if drilldown is not None:
+            with profiling.stage('drilldown'):
+                if 'settlement_df' in summary:
+                    index = index_settlement(summary.pop('settlement_df'))
+                else:
+                    #streamed in chunks or summarized earlier, the rows were never loaded whole
+                    index = load_drilldown(flat_file, kwargs.get('invoiced_file'))
+                tabs.update(drilldown_tabs(index, drilldown))
+        if scenarios is not None:
+            with profiling.stage('scenarios'):
+                tabs.update(scenario_tabs(tabs['Sales'], load_scenarios(scenarios)))
+        result = {
+            'reports': [],
+            'settlement_id': summary['settlement_id'],
+            'statement_period': summary['statement_period'],
+            'tabs': tabs,
+        }
+        if fee_alerts is not None:
+            add_fee_alerts(fee_alerts, result)
+        if export:
+            result['reports'] = export_report(output_prefix, summary['statement_period'], tabs, formats)
+    if profiling.enabled:
+        top = int(os.environ.get('FBA_PROFILE_TOP', '0'))
+        result['reports'].append(profiling.write_trace(output_prefix + '_profile.json', top))
+    return result
+
+def store_settlement(rollup_store, result):
+    '''Saves a processed settlement for rollups'''
+    save_settlement(rollup_store, result['settlement_id'], result['statement_period'], result['tabs']['Sales'], result['tabs']['Overview'])
+
+def run_batch(flat_files, fba_inventory_report, output_folder, workers=None, rollup_store=None, fee_alerts=None, **kwargs):
+    '''Runs every flat file through process_settlement in a process pool. Returns {flat file: files written}.
+    Rollup saves happen here, one at a time, so workers never write the store concurrently. With fee_alerts the
+    reports are written once the pool is done, in statement-period order, each settlement checked against the
+    fee history before it is saved, so the alerts do not depend on which worker finished first'''
+    os.makedirs(output_folder, exist_ok=True)
+    reports = {}
+    prefixes = {flat_file: os.path.join(output_folder, os.path.splitext(os.path.basename(flat_file))[0]) for flat_file in flat_files}
+    processed = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_settlement, flat_file, fba_inventory_report, prefixes[flat_file], export=fee_alerts is None, **kwargs): flat_file
+            for flat_file in flat_files}
+        for future in as_completed(futures):
+            flat_file = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                print(flat_file + ' failed: ' + repr(error), file=sys.stderr)
+                continue
+            if fee_alerts is not None:
+                processed[flat_file] = result
+                continue
+            if rollup_store:
+                store_settlement(rollup_store, result)
+            reports[flat_file] = result['reports']
+            print(flat_file + ' -> ' + ', '.join(reports[flat_file]))
+    for flat_file, result in sorted(processed.items(), key=lambda item: parse_settlement_date(item[1]['statement_period'][1])):
+        add_fee_alerts(fee_alerts, result)
+        if rollup_store:
+            store_settlement(rollup_store, result)
+        reports[flat_file] = export_report(prefixes[flat_file], result['statement_period'], result['tabs'], kwargs.get('formats', ('xlsx',))) + result['reports']
+        print(flat_file + ' -> ' + ', '.join(reports[flat_file]))
+    return reports
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Break down Amazon FBA flat file (v2) revenue by SKU')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--flat-file', help='settlement flat file (v2)')
+    source.add_argument('--batch', metavar='FOLDER', help='process every flat file in this folder')
+    source.add_argument('--watch', metavar='FOLDER', help='keep processing the flat files dropped into this folder')
+    source.add_argument('--accounts', metavar='JSON', help='process the flat files of several accounts, split by account, marketplace and currency')
+    source.add_argument('--inspect', nargs='+', metavar='FLAT_FILE', help='print the metadata of flat files as JSON without building a report')
+    source.add_argument('--memory-report', metavar='FLAT_FILE', help='print the memory each column of a flat file takes, loaded whole against loaded for the report, measured on the first --sample-rows rows')
+    source.add_argument('--trends', nargs='+', metavar='FLAT_FILE', help='export the posted-date trend of every SKU across these flat files (or folders)')
+    source.add_argument('--what-if', metavar='SETTLEMENT_ID', help='export --scenarios for a settlement saved in --rollup-store')
+    source.add_argument('--rollup', choices=['month', 'quarter', 'year'], help='export the settlements in --rollup-store summed by period')
+    parser.add_argument('--fba-archive', help='FBA Inventory Archive report (required with --flat-file and --batch)')
+    parser.add_argument('--storage', help='Monthly Storage Fee report (month before statement end date)')
+    parser.add_argument('--lts', help='Long-Term Storage (Inventory Surcharge) report')
+    parser.add_argument('--advertising', help='Sponsored Products advertised product report (.xlsx)')
+    parser.add_argument('--cost', help='formatted Helium10 cost.csv')
+    parser.add_argument('--invoiced', help='invoiced flat file (v2) to add to the settlement')
+    parser.add_argument('--sku-families', metavar='JSON', help='SKU family rules; adds a Family column and a tab per family')
+    parser.add_argument('--drilldown', nargs='*', metavar='SKU', help='add tabs with every row and the net per order of these SKUs, and the refunds whose sale is not in the settlement')
+    parser.add_argument('--chunksize', type=int, default=None, help='stream flat files in blocks of this many rows instead of loading them whole')
+    parser.add_argument('--sample-rows', type=int, default=100000, help='rows --memory-report measures and scales to the whole file (0 measures the whole file)')
+    parser.add_argument('--cache', metavar='FOLDER', help='keep parsed reports in this folder so re-runs skip parsing (same as FBA_CACHE_DIR)')
+    parser.add_argument('--cache-max-mb', type=int, help='size cap of the cache, least recently used reports are evicted first')
+    parser.add_argument('--rollup-store', metavar='FOLDER', help='save each analyzed settlement here for --rollup')
+    parser.add_argument('--fee-alerts', action='store_true', help='add a Fee Alerts tab comparing each SKU\'s FBA fee per unit and commission percent with earlier settlements in --rollup-store')
+    parser.add_argument('--scenarios', metavar='JSON', help='add tabs comparing the profit and ROI of price, cost and advertising scenarios (see scenarios.py)')
+    parser.add_argument('--format', nargs='+', choices=output_formats, default=['xlsx'], help='output formats, CSV and Parquet write one file per tab')
+    parser.add_argument('--output', default='settlement', help='output file prefix (a folder in batch mode)')
+    parser.add_argument('--profile', action='store_true', help='write the time, peak memory and rows of each stage to <output>_profile.json (same as FBA_PROFILE=1)')
+    parser.add_argument('--profile-top', type=int, metavar='N', help='also print the N slowest stages')
+    parser.add_argument('--threads', type=int, default=None, help='threads loading the reports of a settlement at once (default: one per report, 1 loads them in turn)')
+    parser.add_argument('--interval', type=int, default=60, help='with --watch, seconds between polls of the folder')
+    parser.add_argument('--wait-minutes', type=int, default=60, help='with --watch, how long a settlement charged for storage or LTS waits for that report')
+    parser.add_argument('--once', action='store_true', help='with --watch, stop when nothing is left to run instead of polling')
+    parser.add_argument('--trend-period', choices=['day', 'week'], default='day', help='with --trends, bucket rows by posted day or week')
+    parser.add_argument('--trend-window', type=int, help='with --trends, periods in the rolling columns (default: 7 days or 4 weeks)')
+    parser.add_argument('--partition-files', action='store_true', help='with --accounts, also write a report per partition')
+    parser.add_argument('--workers', type=int, default=None, help='processes used in batch mode (default: CPU count)')
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.inspect:
+        metadata = {flat_file: inspect_settlement(flat_file, args.chunksize or 1000000) for flat_file in args.inspect}
+        print(json.dumps(metadata, indent=1))
+        return 0
+    if args.memory_report:
+        print(schema_memory_report(args.memory_report, args.sample_rows or None).to_string(float_format='{:,.1f}'.format))
+        return 0
+    #set through the environment so batch worker processes see it too
+    if args.cache:
+        os.environ['FBA_CACHE_DIR'] = args.cache
+    if args.cache_max_mb:
+        os.environ['FBA_CACHE_MAX_MB'] = str(args.cache_max_mb)
+    if args.profile or args.profile_top:
+        profiling.enable()
+    if args.profile_top:
+        os.environ['FBA_PROFILE_TOP'] = str(args.profile_top)
+    if args.fee_alerts and not args.rollup_store:
+        parser.error('--fee-alerts needs --rollup-store')
+    #a watched folder brings its own cost report
+    if args.scenarios and (args.flat_file or args.batch) and not args.cost:
+        parser.error('--scenarios needs --cost')
+    if args.accounts:
+        print('\n'.join(run_accounts(load_accounts(args.accounts), args.output, args.workers, args.format, args.partition_files)))
+        return 0
+    if args.trends:
+        trends = trend_table(args.trends, args.trend_period, args.trend_window, args.workers)
+        print('\n'.join(export_trends(args.output, trends, args.trend_period, args.format)))
+        return 0
+    if args.what_if:
+        if not args.rollup_store or not args.scenarios:
+            parser.error('--what-if needs --rollup-store and --scenarios')
+        stored = load_settlement(args.rollup_store, args.what_if)
+        print('\n'.join(write_report(args.output, scenario_tabs(stored['main'], load_scenarios(args.scenarios)), args.format)))
+        return 0
+    if args.rollup:
+        if not args.rollup_store:
+            parser.error('--rollup needs --rollup-store')
+        print('\n'.join(export_rollup(args.output, args.rollup_store, args.rollup, args.format)))
+        return 0
+    if args.watch:
+        kwargs = report_kwargs(args)
+        for name in ['storage_report', 'lts_report', 'advertising_report']:
+            del kwargs[name]
+        store = (lambda result: store_settlement(args.rollup_store, result)) if args.rollup_store else None
+        watch(args.watch, args.output, process_settlement, store, args.workers or 2, args.interval, args.wait_minutes, once=args.once, **kwargs)
+        return 0
+    if not args.fba_archive:
+        parser.error('--fba-archive is required')
+    if args.batch:
+        flat_files = find_flat_files(args.batch)
+        if not flat_files:
+            print('No settlement flat files found in ' + args.batch, file=sys.stderr)
+            return 1
+        reports = run_batch(flat_files, args.fba_archive, args.output, args.workers, args.rollup_store, **report_kwargs(args))
+        return 0 if len(reports) == len(flat_files) else 1
+    result = process_settlement(args.flat_file, args.fba_archive, args.output, **report_kwargs(args))
+    if args.rollup_store:
+        store_settlement(args.rollup_store, result)
+    print('\n'.join(result['reports']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
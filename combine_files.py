@@ -1,24 +1,108 @@
-import PySimpleGUI as sg
-
-layout = [[sg.Text('Select two files to combine')],
-          [sg.Input(key='-FILE1-', enable_events=True, visible=True), sg.FileBrowse('Browse', key='-BROWSE1-')],
-          [sg.Input(key='-FILE2-', enable_events=True, visible=True), sg.FileBrowse('Browse', key='-BROWSE2-')],
-          [sg.Button('Combine', key='-COMBINE-')]]
-
-window = sg.Window('File Combiner', layout)
-
-while True:
-    event, values = window.read()
-    if event == sg.WIN_CLOSED:
-        break
-    if event == '-COMBINE-':
-        file1 = values['-FILE1-']
-        file2 = values['-FILE2-']
-        with open(file1, 'rb') as f1:
-            data1 = f1.read()
-        with open(file2, 'rb') as f2:
-            data2 = f2.read()
-        with open('combined_file.txt', 'wb') as f3:
-            f3.write(data1 + data2)
-        sg.popup('Files combined successfully!', title='Success')
-window.close()
\ No newline at end of file
+'''Combines settlement and invoiced flat files (v2) into one flat file.
+
+Files are streamed line by line, so memory stays the same however large they are. Only the first file's header
+and settlement summary row (the total amount/date row) are kept, and the rows of a settlement-id an earlier file
+already wrote are skipped, so overlapping downloads are not counted twice.
+
+    python combine_files.py settlement.txt invoiced.txt --output combined_file.txt
+Without arguments it asks for two files through dialogs.
+'''
+import argparse
+import os
+import sys
+
+def split_row(line):
+    return line.rstrip(b'\r\n').split(b'\t')
+
+def is_summary_row(header, line):
+    '''The row under the header with the settlement totals and dates, which has no transaction-type'''
+    row = dict(zip(header, split_row(line)))
+    return not row.get(b'transaction-type') and bool(row.get(b'total-amount'))
+
+def row_settlement_id(line, column):
+    '''The settlement-id of a row, splitting only the fields up to it'''
+    fields = line.rstrip(b'\r\n').split(b'\t', column + 1)
+    return fields[column] if len(fields) > column else b''
+
+def combine_flat_files(paths, output, buffer_size=1024 * 1024):
+    '''Writes the flat files one after the other to output. Returns the files combined and the (file, settlement-id)
+    blocks skipped because an earlier file already wrote that settlement-id'''
+    header = None
+    written_ids = set()
+    combined = []
+    skipped = []
+    with open(output, 'wb', buffering=buffer_size) as out:
+        for path in paths:
+            with open(path, 'rb', buffering=buffer_size) as f:
+                header_line = f.readline()
+                if header is None:
+                    header = split_row(header_line)
+                    column = header.index(b'settlement-id') if b'settlement-id' in header else 0
+                    out.write(header_line if header_line.endswith(b'\n') else header_line + b'\n')
+                elif split_row(header_line) != header:
+                    raise ValueError(path + ' does not have the same columns as ' + paths[0])
+                file_ids = set()
+                first = True
+                #rows of a settlement come in one block, so the row's start is checked against the block's first
+                prefix = None
+                for line in f:
+                    if first:
+                        first = False
+                        if combined and is_summary_row(header, line):
+                            continue
+                    if prefix is None or not line.startswith(prefix):
+                        settlement_id = row_settlement_id(line, column)
+                        prefix = settlement_id + b'\t' if column == 0 and settlement_id else None
+                        if settlement_id not in file_ids:
+                            file_ids.add(settlement_id)
+                            if settlement_id and settlement_id in written_ids:
+                                skipped.append((path, settlement_id.decode()))
+                        keep = not settlement_id or settlement_id not in written_ids
+                    if keep:
+                        out.write(line if line.endswith(b'\n') else line + b'\n')
+                written_ids |= file_ids
+            combined.append(path)
+    return combined, skipped
+
+def cache_combined(output, cache_folder):
+    '''Parses the combined file once into the report cache (see report_cache), so the next run reads the columnar copy'''
+    os.environ['FBA_CACHE_DIR'] = cache_folder
+    from main import read_settlement
+    read_settlement(output)
+
+def run_gui():
+    import PySimpleGUI as sg
+    layout = [[sg.Text('Select two files to combine')],
+              [sg.Input(key='-FILE1-', enable_events=True, visible=True), sg.FileBrowse('Browse', key='-BROWSE1-')],
+              [sg.Input(key='-FILE2-', enable_events=True, visible=True), sg.FileBrowse('Browse', key='-BROWSE2-')],
+              [sg.Button('Combine', key='-COMBINE-')]]
+    window = sg.Window('File Combiner', layout)
+    while True:
+        event, values = window.read()
+        if event == sg.WIN_CLOSED:
+            break
+        if event == '-COMBINE-':
+            combined, skipped = combine_flat_files([values['-FILE1-'], values['-FILE2-']], 'combined_file.txt')
+            if skipped:
+                sg.popup('Skipped settlement ' + ', '.join(settlement_id for path, settlement_id in skipped) + ' of the second file, it is already in the first', title='Duplicate settlement')
+            sg.popup('Files combined successfully!', title='Success')
+    window.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Combine settlement and invoiced flat files (v2)')
+    parser.add_argument('flat_files', nargs='+', help='flat files, the first one gives the header and summary row')
+    parser.add_argument('--output', default='combined_file.txt')
+    parser.add_argument('--cache', metavar='FOLDER', help='also parse the combined file into this report cache')
+    args = parser.parse_args(argv)
+    combined, skipped = combine_flat_files(args.flat_files, args.output)
+    for path, settlement_id in skipped:
+        print('skipped settlement ' + settlement_id + ' of ' + path + ', it is already in ' + args.output, file=sys.stderr)
+    if args.cache:
+        cache_combined(args.output, args.cache)
+    print(args.output)
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    run_gui()
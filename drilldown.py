@@ -0,0 +1,144 @@
+'''Order and transaction level drilldown over a settlement.
+
+The rows needed to trace a SKU back to its orders are kept sorted by SKU and order-id, with the row order by
+order-id and by adjustment-id stored alongside, so "every row of SKU X" or "every row of order Y" is a binary
+search and a slice instead of a scan. The rows are read with the same columns (report_columns) as the report
+when a drilldown is asked for, so with FBA_CACHE_DIR set both share one cached parse of the flat file.
+'''
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from main import as_category, read_invoiced, read_settlement, summary_columns
+
+drilldown_columns = ['sku', 'order-id', 'adjustment-id', 'transaction-type', 'amount-type', 'amount-description', 'amount',
+    'fulfillment-id', 'posted-date', 'quantity-purchased']
+
+#what read_settlement loads when the drilldown is built from the same read as the report
+report_columns = summary_columns + [column for column in drilldown_columns if column not in summary_columns]
+
+#columns holding the row positions sorted by order-id and by adjustment-id
+order_position = 'by-order'
+adjustment_position = 'by-adjustment'
+
+def concat_rows(parts):
+    '''Concatenates row frames, merging the categories of each categorical column instead of falling back to object'''
+    columns = {}
+    for column in parts[0].columns:
+        if isinstance(parts[0][column].dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals([as_category(part[column]).array for part in parts])
+        else:
+            columns[column] = pd.concat([part[column] for part in parts], ignore_index=True)
+    return pd.DataFrame(columns)
+
+def sort_rows(rows):
+    '''Sorts drilldown rows by SKU then order-id and stores the row order by order-id and by adjustment-id'''
+    rows = rows[drilldown_columns].copy()
+    for column in ['sku', 'order-id', 'adjustment-id']:
+        rows[column] = as_category(rows[column])
+    sku_codes = rows['sku'].cat.codes.to_numpy()
+    order_codes = rows['order-id'].cat.codes.to_numpy()
+    rows = rows.take(np.lexsort((order_codes, sku_codes))).reset_index(drop=True)
+    rows[order_position] = np.argsort(rows['order-id'].cat.codes.to_numpy(), kind='stable')
+    rows[adjustment_position] = np.argsort(rows['adjustment-id'].cat.codes.to_numpy(), kind='stable')
+    return rows
+
+def read_rows(flat_file, invoiced=False):
+    '''Returns the drilldown rows of a flat file (or of an invoiced file without its total row), sorted. They are read
+    with report_columns, the columns the report loads when a drilldown is asked for, so both share one cached parse'''
+    reader = read_invoiced if invoiced else read_settlement
+    return sort_rows(reader(flat_file, report_columns))
+
+def matching_rows(sorted_codes, categories, value):
+    '''Returns the start and end of the run of value's code in sorted_codes'''
+    code = categories.get_indexer([value])[0]
+    if code < 0:
+        return 0, 0
+    return np.searchsorted(sorted_codes, code, 'left'), np.searchsorted(sorted_codes, code, 'right')
+
+class DrilldownIndex:
+    '''SKU, order-id and adjustment-id lookups over the sorted rows of a settlement'''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.sku_codes = rows['sku'].cat.codes.to_numpy()
+        self.by_order = rows[order_position].to_numpy()
+        self.by_adjustment = rows[adjustment_position].to_numpy()
+        self.order_codes = rows['order-id'].cat.codes.to_numpy()[self.by_order]
+        self.adjustment_codes = rows['adjustment-id'].cat.codes.to_numpy()[self.by_adjustment]
+
+    def rows_for_sku(self, sku):
+        '''Returns every row of a SKU, by order-id'''
+        start, end = matching_rows(self.sku_codes, self.rows['sku'].cat.categories, sku)
+        return self.rows.iloc[start:end][drilldown_columns]
+
+    def rows_for_order(self, order_id):
+        '''Returns every row of an order'''
+        start, end = matching_rows(self.order_codes, self.rows['order-id'].cat.categories, order_id)
+        return self.rows.take(self.by_order[start:end])[drilldown_columns]
+
+    def rows_for_adjustment(self, adjustment_id):
+        '''Returns every row of an adjustment (refund, reimbursement)'''
+        start, end = matching_rows(self.adjustment_codes, self.rows['adjustment-id'].cat.categories, adjustment_id)
+        return self.rows.take(self.by_adjustment[start:end])[drilldown_columns]
+
+    def net_per_order(self, sku):
+        '''Returns a SKU's amount per order and transaction-type, the net of each order and the units sold in it.
+        Rows without an order-id (reimbursements, adjustments) are grouped under a missing order-id'''
+        rows = self.rows_for_sku(sku)
+        order_id = rows['order-id'].cat.remove_unused_categories()
+        by_type = rows.groupby([order_id, rows['transaction-type']], observed=True, dropna=False)['amount'].sum()
+        orders = by_type.unstack(fill_value=0)
+        orders.columns = [str(column) for column in orders.columns]
+        orders['Net'] = orders.sum(axis=1)
+        sold = (rows['amount-description'] == 'Principal') & (rows['transaction-type'] == 'Order')
+        units = rows['quantity-purchased'].where(sold, 0).fillna(0).groupby(order_id, observed=True, dropna=False).sum()
+        orders['Units Sold'] = units.reindex(orders.index, fill_value=0).astype(np.int64)
+        return orders
+
+    def orders_with_refunds_without_principal(self):
+        '''Returns the orders refunded in this settlement whose sale (Principal) is not in it, with the refunded
+        amount by SKU. Found with two bincounts over the order-id codes'''
+        rows = self.rows
+        order_codes = rows['order-id'].cat.codes.to_numpy()
+        order_count = len(rows['order-id'].cat.categories)
+        has_order = order_codes >= 0
+        refund = (rows['transaction-type'] == 'Refund').to_numpy()
+        principal = ((rows['amount-description'] == 'Principal') & (rows['transaction-type'] == 'Order')).to_numpy()
+        refunded = np.bincount(order_codes[has_order & refund], minlength=order_count) > 0
+        sold = np.bincount(order_codes[has_order & principal], minlength=order_count) > 0
+        #trailing False so that a -1 (missing) code is never selected
+        selected = np.append(refunded & ~sold, False)
+        refund_rows = rows.loc[selected[order_codes] & refund]
+        orders = refund_rows.groupby(['order-id', 'sku'], observed=True).agg(
+            **{'Refund Amount': ('amount', 'sum'), 'Rows': ('amount', 'size'), 'Posted Date': ('posted-date', 'first')})
+        return orders.reset_index(level='sku')
+
+def index_settlement(settlement_df):
+    '''Returns the DrilldownIndex of rows already read with (at least) the drilldown columns, see report_columns'''
+    return DrilldownIndex(sort_rows(settlement_df))
+
+def load_drilldown(flat_file, invoiced_file=None):
+    '''Returns the DrilldownIndex of a settlement and its invoiced file, if any, for runs whose report did not
+    load the rows whole (streamed in chunks or summarized earlier)'''
+    rows = read_rows(flat_file)
+    if invoiced_file is not None:
+        rows = sort_rows(concat_rows([rows[drilldown_columns], read_rows(invoiced_file, invoiced=True)[drilldown_columns]]))
+    return DrilldownIndex(rows)
+
+def drilldown_tabs(drilldown, skus=()):
+    '''Returns the drilldown tabs: every row and the net per order of each SKU asked for, and the refunded orders
+    whose sale is not in the settlement'''
+    tabs = {}
+    if skus:
+        tabs['Drilldown Rows'] = pd.concat([drilldown.rows_for_sku(sku) for sku in skus]).set_index('sku')
+        orders = []
+        for sku in skus:
+            sku_orders = drilldown.net_per_order(sku)
+            sku_orders.insert(0, 'sku', sku)
+            orders.append(sku_orders)
+        orders = pd.concat(orders)
+        #a transaction-type one SKU has and another hasn't
+        tabs['Drilldown Orders'] = orders.fillna({column: 0 for column in orders.columns if column != 'sku'})
+    tabs['Refunds Without Sale'] = drilldown.orders_with_refunds_without_principal()
+    return tabs
@@ -0,0 +1,126 @@
+'''Fee anomaly detection across settlements.
+
+A compact fee history (units sold, sales revenue, commission and FBA fees per SKU and settlement) is kept in the
+rollup store next to the stored settlements, one file per settlement. A settlement's FBA fee per unit and commission percent are compared
+with the same SKU's rates in the settlements that ended before it: the baseline is their median and the spread
+their median absolute deviation (MAD), computed for every SKU at once over a SKU x settlement matrix. A rate whose
+robust z-score passes the threshold is listed on the Fee Alerts tab, which catches fee tier changes and overcharges
+that a single settlement cannot show.
+'''
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from main import parse_settlement_date, restore_column_names
+
+#summed columns of the main table kept per SKU and settlement
+fee_history_columns = ['Units Sold', 'Sales Revenue', 'Commission', 'FBA Fees']
+
+#rate -> (numerator, denominator, sign), the same ratios as the main table
+fee_rates = {
+    'FBA Fee Average': ('FBA Fees', 'Units Sold', 1),
+    'Commission Percent': ('Commission', 'Sales Revenue', -1),
+}
+
+#scales the MAD to a standard deviation for normally distributed rates
+mad_scale = 1.4826
+
+def history_folder(store):
+    return os.path.join(store, 'fee_history')
+
+def history_rows(settlement_id, statement_period, main_df):
+    '''Returns the fee history rows of one settlement from its main table (short or full column names)'''
+    main_df = restore_column_names(main_df)
+    rows = main_df.loc[main_df['Units Sold'] > 0, fee_history_columns].astype(np.float64)
+    rows.index.name = 'sku'
+    rows = rows.reset_index()
+    rows.insert(0, 'settlement-id', str(settlement_id))
+    rows.insert(1, 'end', statement_period[1])
+    return rows
+
+def load_fee_history(store):
+    '''Returns the fee history of a rollup store, the rows of every settlement recorded in it'''
+    folder = history_folder(store)
+    parts = []
+    if os.path.isdir(folder):
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith('.pkl'):
+                with open(os.path.join(folder, filename), 'rb') as f:
+                    parts.append(pickle.load(f))
+    if not parts:
+        return pd.DataFrame(columns=['settlement-id', 'end', 'sku'] + fee_history_columns)
+    return pd.concat(parts, ignore_index=True)
+
+def record_fees(store, settlement_id, statement_period, main_df):
+    '''Adds (or replaces) a settlement in the fee history of a rollup store. Each settlement has a file of its own,
+    so recording one never reads or rewrites the others'''
+    os.makedirs(history_folder(store), exist_ok=True)
+    path = os.path.join(history_folder(store), str(settlement_id) + '.pkl')
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump(history_rows(settlement_id, statement_period, main_df), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+def rate_values(rows, rate):
+    numerator, denominator, sign = fee_rates[rate]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = rows[numerator].to_numpy(dtype=np.float64) / rows[denominator].to_numpy(dtype=np.float64) * sign
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+def find_fee_alerts(history, settlement_id, statement_period, main_df, threshold=3.5, min_settlements=3, min_change=0.02):
+    '''Returns the SKUs of a settlement whose FBA fee per unit or commission percent is off their baseline, one row
+    per SKU and rate. Only settlements in history that ended before this one count, and a SKU needs
+    min_settlements of them. The spread never goes below min_change of the baseline, so a fee that was the same
+    every time is flagged once it moves by more than that (times threshold / 1.4826)'''
+    current = history_rows(settlement_id, statement_period, main_df).set_index('sku')
+    #end dates are parsed once per settlement, not compared as strings
+    ends = history['end'].unique()
+    ended = pd.to_datetime(history['end'].map(dict(zip(ends, [parse_settlement_date(end) for end in ends]))), utc=True)
+    past = history.loc[(ended < parse_settlement_date(statement_period[1])).to_numpy() & (history['settlement-id'] != str(settlement_id)).to_numpy()]
+    sku_codes = current.index.get_indexer(past['sku'])
+    past = past.loc[sku_codes >= 0]
+    sku_codes = sku_codes[sku_codes >= 0]
+    settlement_codes, settlements = pd.factorize(past['settlement-id'])
+    alerts = []
+    for rate in fee_rates:
+        #SKU x earlier settlement, NaN where the SKU did not sell
+        matrix = np.full((len(current), len(settlements)), np.nan)
+        matrix[sku_codes, settlement_codes] = rate_values(past, rate)
+        counts = np.sum(~np.isnan(matrix), axis=1)
+        enough = counts >= min_settlements
+        baseline = np.full(len(current), np.nan)
+        spread = np.full(len(current), np.nan)
+        if enough.any():
+            baseline[enough] = np.nanmedian(matrix[enough], axis=1)
+            mad = np.nanmedian(np.abs(matrix[enough] - baseline[enough, None]), axis=1)
+            spread[enough] = np.maximum(mad * mad_scale, np.abs(baseline[enough]) * min_change)
+        values = rate_values(current, rate)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_scores = (values - baseline) / spread
+        flagged = enough & np.isfinite(z_scores) & (np.abs(z_scores) > threshold)
+        if not flagged.any():
+            continue
+        rate_alerts = pd.DataFrame({
+            'Rate': rate,
+            'Current': values[flagged],
+            'Baseline': baseline[flagged],
+            'Change': values[flagged] - baseline[flagged],
+            'Z-Score': z_scores[flagged],
+            'Settlements': counts[flagged],
+            'Units Sold': current['Units Sold'].to_numpy()[flagged].astype(np.int64),
+        }, index=current.index[flagged])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate_alerts.insert(4, 'Change %', rate_alerts['Change'] / rate_alerts['Baseline'].abs())
+        alerts.append(rate_alerts)
+    if not alerts:
+        return pd.DataFrame(columns=['Rate', 'Current', 'Baseline', 'Change', 'Change %', 'Z-Score', 'Settlements', 'Units Sold'],
+            index=pd.Index([], name='sku'))
+    alerts = pd.concat(alerts).replace([np.inf, -np.inf], np.nan)
+    return alerts.iloc[np.argsort(-alerts['Z-Score'].abs().to_numpy(), kind='stable')]
+
+def get_fee_alerts(store, settlement_id, statement_period, main_df):
+    '''Returns the Fee Alerts tab of a settlement against the fee history of a rollup store'''
+    return find_fee_alerts(load_fee_history(store), settlement_id, statement_period, main_df)
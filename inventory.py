@@ -0,0 +1,72 @@
+'''Lookups over the FBA Inventory Archive report.
+
+The archive is indexed once: SKUs and FNSKUs get integer codes, every (fnsku, sku) pair is kept (one FNSKU can
+be listed under several SKUs), and the ASIN/title of each SKU is stored by code. Storage and LTS fees are then
+moved from FNSKU to SKU with integer takes and bincounts instead of a groupby + concat per report.
+'''
+import numpy as np
+import pandas as pd
+
+class InventoryIndex:
+    '''fnsku -> sku(s) and sku -> (asin, title) lookups built from the FBA Inventory Archive'''
+
+    def __init__(self, manage_fba_inventory_df):
+        archive = manage_fba_inventory_df.dropna(subset=['sku'])
+        sku_codes, self.skus = pd.factorize(archive['sku'].astype(str), sort=True)
+        self.skus = pd.Index(self.skus, name='sku')
+        #asin and title of the first archive row of each SKU
+        first_rows = pd.Series(np.arange(len(archive))).groupby(sku_codes).first().to_numpy()
+        self.asins = archive['asin'].to_numpy()[first_rows] if 'asin' in archive else np.full(len(self.skus), np.nan, dtype=object)
+        self.titles = archive['product-name'].to_numpy()[first_rows] if 'product-name' in archive else np.full(len(self.skus), np.nan, dtype=object)
+        if 'fnsku' in archive:
+            archive = archive.assign(sku_code=sku_codes).dropna(subset=['fnsku'])
+            fnsku_codes, self.fnskus = pd.factorize(archive['fnsku'].astype(str), sort=True)
+            self.fnskus = pd.Index(self.fnskus, name='fnsku')
+            pairs = np.unique(np.column_stack([fnsku_codes, archive['sku_code'].to_numpy()]), axis=0).reshape(-1, 2)
+        else:
+            self.fnskus = pd.Index([], name='fnsku')
+            pairs = np.empty((0, 2), dtype=np.int64)
+        #pairs are sorted by fnsku code, so the skus of fnsku i are pair_skus[offsets[i]:offsets[i + 1]]
+        self.pair_fnskus = pairs[:, 0]
+        self.pair_skus = pairs[:, 1]
+        self.skus_per_fnsku = np.bincount(self.pair_fnskus, minlength=len(self.fnskus))
+        self.offsets = np.concatenate([[0], np.cumsum(self.skus_per_fnsku)])
+
+    def skus_for_fnsku(self, fnsku):
+        '''Returns every SKU listed under an FNSKU (empty if it is not in the archive)'''
+        position = self.fnskus.get_indexer([fnsku])[0]
+        if position < 0:
+            return []
+        return list(self.skus[self.pair_skus[self.offsets[position]:self.offsets[position + 1]]])
+
+    def asin_and_title(self, sku):
+        '''Returns (asin, title) of a SKU, (None, None) if it is not in the archive'''
+        position = self.skus.get_indexer([sku])[0]
+        if position < 0:
+            return None, None
+        return self.asins[position], self.titles[position]
+
+    def asin_and_title_table(self):
+        '''Returns asin and product-name by SKU'''
+        return pd.DataFrame({'asin': self.asins, 'product-name': self.titles}, index=self.skus)
+
+    def allocate_by_fnsku(self, fnskus, amounts):
+        '''Moves amounts keyed by FNSKU onto SKUs. An FNSKU listed under several SKUs is split evenly between them;
+        FNSKUs missing from the archive are dropped. Returns a Series by SKU covering every SKU that received an amount'''
+        fnsku_codes = self.fnskus.get_indexer(pd.Index(fnskus).astype(str))
+        amounts = np.nan_to_num(np.asarray(amounts, dtype=np.float64))
+        found = fnsku_codes >= 0
+        by_fnsku = np.bincount(fnsku_codes[found], weights=amounts[found], minlength=len(self.fnskus))
+        charged = np.zeros(len(self.fnskus), dtype=bool)
+        charged[fnsku_codes[found]] = True
+        shares = by_fnsku[self.pair_fnskus] / self.skus_per_fnsku[self.pair_fnskus]
+        by_sku = np.bincount(self.pair_skus, weights=shares, minlength=len(self.skus))
+        received = np.zeros(len(self.skus), dtype=bool)
+        received[self.pair_skus[charged[self.pair_fnskus]]] = True
+        return pd.Series(by_sku[received], index=self.skus[received])
+
+def as_inventory_index(manage_fba_inventory):
+    '''Accepts an InventoryIndex or the archive dataframe'''
+    if isinstance(manage_fba_inventory, InventoryIndex):
+        return manage_fba_inventory
+    return InventoryIndex(manage_fba_inventory)
@@ -1,7 +1,18 @@
 import pandas as pd
-import xlsxwriter
 import numpy as np
-import PySimpleGUI as sg
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from inventory import as_inventory_index
+import profiling
+from profiling import profiled
+from report_cache import cached_read
+from report_writer import write_report
 
 pd.set_option('display.precision', 2)
 
@@ -25,6 +36,7 @@ dtypes = {
     "marketplace-name": "category",
     "amount-type": "category",
     "amount-description": "category",
+    #dollars, summed as int64 cents by amount_cents; int64 cents would take the same 8 bytes a row
     "amount": "float64",
     "fulfillment-id": "category",
     "posted-date": "category",
@@ -37,6 +49,131 @@ dtypes = {
     "promotion-id": "category",
 }
 
+#amount-description sets used to pick out rows of the settlement
+fba_fee_descriptions = ['FBAPerOrderFulfillmentFee', 'FBAPerUnitFulfillmentFee', 'FBAWeightBasedFee']
+
+#units taken from inventory and compensated but not as sale
+nonsales_unit_descriptions = ['FREE_REPLACEMENT_REFUND_ITEMS', 'RefundCommission', 'REVERSAL_REIMBURSEMENT',
+    'WAREHOUSE_DAMAGE', 'WAREHOUSE_DAMAGE_EXCEPTION', 'WAREHOUSE_LOST', 'WAREHOUSE_LOST_MANUAL',
+    'CS_ERROR_ITEMS', 'MISSING_FROM_INBOUND']
+
+nonsales_revenue_descriptions = ['COMPENSATED_CLAWBACK', 'FREE_REPLACEMENT_REFUND_ITEMS', 'RefundCommission',
+    'REVERSAL_REIMBURSEMENT', 'WAREHOUSE_DAMAGE', 'WAREHOUSE_DAMAGE_EXCEPTION', 'WAREHOUSE_LOST',
+    'WAREHOUSE_LOST_MANUAL', 'VariableClosingFee', 'ShippingChargeback', 'Shipping', 'MISSING_FROM_INBOUND',
+    'CS_ERROR_ITEMS', 'Goodwill', 'ShippingHB', 'RestockingFee']
+
+#line items without a SKU
+non_sku_descriptions = ['Subscription Fee', 'Previous Reserve Amount Balance', 'Current Reserve Amount',
+    'RemovalComplete', 'Adjustment', 'DisposalComplete', 'FBACustomerReturnPerUnitFee', 'Shipping label purchase',
+    'Shipping label purchase for return', 'INCORRECT_FEES_NON_ITEMIZED', 'FBAInboundTransportationFee',
+    'FBA Pick & Pack Fee', 'StorageRenewalBilling', 'Manual Processing Fee', 'Manual Processing Fee Reimbursement',
+    'NonSubscriptionFeeAdj']
+
+#amount-description -> main table column its amount is summed into
+revenue_buckets = {'Principal': 'Sales Revenue', 'Commission': 'Commission'}
+revenue_buckets.update(dict.fromkeys(fba_fee_descriptions, 'FBA Fees'))
+revenue_buckets.update(dict.fromkeys(nonsales_revenue_descriptions, 'Non-Sales Revenue'))
+
+#(amount-description, fulfillment-id) -> main table column its quantity-purchased is summed into
+#a fulfillment-id of None matches every fulfillment
+unit_buckets = {
+    ('Principal', 'AFN'): 'Units Sold',
+    ('Principal', 'MFN'): 'Merchant Fulfilled Units',
+}
+unit_buckets.update({(description, None): 'Non-Sale Units' for description in nonsales_unit_descriptions})
+
+#amount-description of a Refund row -> refund tab column its amount is summed into, the rest go to Other Refund Charges
+refund_buckets = {'Principal': 'Refunded Sales', 'Commission': 'Refunded Commission', 'RefundCommission': 'Refund Commission',
+    'RestockingFee': 'Restocking Fee'}
+refund_columns = ['Refunded Sales', 'Refunded Commission', 'Refund Commission', 'Restocking Fee', 'Other Refund Charges']
+
+#flat file columns the report is built from, the rest are skipped when streaming
+summary_columns = ['settlement-id', 'settlement-start-date', 'settlement-end-date', 'currency', 'transaction-type', 'amount-description', 'amount', 'fulfillment-id', 'sku', 'quantity-purchased']
+
+#every column of the flat file, for callers that need more than the report does
+settlement_columns = list(dtypes)
+
+#near-unique identifiers: slow to parse as categories for little saving, so read as pyarrow strings when pyarrow is installed
+identifier_columns = ['order-id', 'merchant-order-id', 'adjustment-id', 'shipment-id', 'posted-date-time', 'order-item-code',
+    'merchant-order-item-id', 'merchant-adjustment-item-id', 'promotion-id']
+identifier_dtype = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else 'category'
+
+def settlement_dtypes(columns):
+    '''Returns the dtype each of these flat file columns is parsed as'''
+    return {column: identifier_dtype if column in identifier_columns else dtypes[column] for column in columns}
+
+unit_columns = ['Units Sold', 'Non-Sale Units', 'Merchant Fulfilled Units']
+revenue_columns = ['Sales Revenue', 'Commission', 'FBA Fees', 'Non-Sales Revenue']
+
+def as_category(column):
+    '''Returns the column as a categorical (columns lose their category dtype when files are concatenated)'''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column
+    return column.astype('category')
+
+def select_descriptions(settlement_df, descriptions):
+    '''Returns a boolean mask of the rows whose amount-description is in descriptions.
+    The set is resolved to category codes once, then rows are picked with a single lookup'''
+    description = as_category(settlement_df['amount-description'])
+    #trailing False so that a -1 (missing) code is never selected
+    lookup = np.append(description.cat.categories.isin(descriptions), False)
+    return lookup[description.cat.codes.to_numpy()]
+
+def sum_by_sku_and_bucket(sku_codes, bucket_codes, values, sku_count, bucket_count):
+    '''Sums values into a sku x bucket grid in one pass. Rows with a -1 code are ignored'''
+    keep = (sku_codes >= 0) & (bucket_codes >= 0)
+    flat_index = sku_codes[keep].astype(np.int64) * bucket_count + bucket_codes[keep]
+    totals = np.bincount(flat_index, weights=values[keep], minlength=sku_count * bucket_count)
+    return totals.reshape(sku_count, bucket_count)
+
+@profiled
+def amount_cents(settlement_df):
+    '''Returns the amount column as int64 cents. Sums of cents are exact (up to 2**53 cents), where sums of float
+    dollars drift over millions of rows'''
+    return np.rint(settlement_df['amount'].fillna(0).to_numpy(dtype=np.float64) * 100).astype(np.int64)
+
+def revenue_bucket_codes(settlement_df):
+    '''Returns the position in revenue_columns each row's amount is summed into, -1 for none'''
+    description = as_category(settlement_df['amount-description'])
+    descriptions = description.cat.categories
+    #lookup tables have a trailing slot so that a -1 (missing) code lands on "no bucket"
+    revenue_lookup = np.full(len(descriptions) + 1, -1, dtype=np.int64)
+    for position, name in enumerate(descriptions):
+        if name in revenue_buckets:
+            revenue_lookup[position] = revenue_columns.index(revenue_buckets[name])
+    return revenue_lookup[description.cat.codes.to_numpy()]
+
+def unit_bucket_codes(settlement_df):
+    '''Returns the position in unit_columns each row's quantity-purchased is summed into, -1 for none'''
+    description = as_category(settlement_df['amount-description'])
+    fulfillment = as_category(settlement_df['fulfillment-id'])
+    descriptions = description.cat.categories
+    fulfillments = fulfillment.cat.categories
+    unit_lookup = np.full((len(descriptions) + 1, len(fulfillments) + 1), -1, dtype=np.int64)
+    for (name, fulfillment_id), column in unit_buckets.items():
+        if name not in descriptions:
+            continue
+        row = descriptions.get_loc(name)
+        if fulfillment_id is None:
+            unit_lookup[row, :] = unit_columns.index(column)
+        elif fulfillment_id in fulfillments:
+            unit_lookup[row, fulfillments.get_loc(fulfillment_id)] = unit_columns.index(column)
+    return unit_lookup[description.cat.codes.to_numpy(), fulfillment.cat.codes.to_numpy()]
+
+def get_sku_metrics(settlement_df):
+    '''Returns units, revenue, commission, fees and non-sales revenue by SKU from a single pass over the settlement'''
+    sku = as_category(settlement_df['sku'])
+    sku_codes = sku.cat.codes.to_numpy()
+    amounts = amount_cents(settlement_df)
+    quantities = settlement_df['quantity-purchased'].fillna(0).to_numpy(dtype=np.float64)
+    revenue = sum_by_sku_and_bucket(sku_codes, revenue_bucket_codes(settlement_df), amounts, len(sku.cat.categories), len(revenue_columns)) / 100
+    units = sum_by_sku_and_bucket(sku_codes, unit_bucket_codes(settlement_df), quantities, len(sku.cat.categories), len(unit_columns))
+    index = pd.Index(sku.cat.categories, name='sku')
+    sku_metrics = pd.DataFrame(np.rint(units).astype(np.int64), index=index, columns=unit_columns)
+    sku_metrics[revenue_columns] = revenue
+    return sku_metrics
+
+@profiled
 def get_units_sold(settlement_df):
     '''Get's all units sold (only units charged a comission via AFN)'''
     units_sold = settlement_df.loc[(settlement_df['fulfillment-id']== 'AFN') & (settlement_df['amount-description']=='Principal')]
@@ -44,13 +181,10 @@ def get_units_sold(settlement_df):
     units_sold = units_sold.groupby('sku').sum()
     return units_sold.rename(columns={'quantity-purchased':'Units Sold'})
 
+@profiled
 def get_nonsales_units(settlement_df):
     '''Returns units taken from inventory and compensated but not as sale'''
-    #ns_units = settlement_df.loc[(settlement_df['amount-description'] == 'WAREHOUSE_LOST') | (settlement_df['amount-description'] == 'WAREHOUSE_DAMAGE') | (settlement_df['amount-description'] == 'FREE_REPLACEMENT_REFUND_ITEMS')]
-    ns_units = settlement_df.loc[(settlement_df['amount-description'] == 'FREE_REPLACEMENT_REFUND_ITEMS') | (settlement_df['amount-description'] == 'RefundCommission') | (settlement_df['amount-description'] == 'REVERSAL_REIMBURSEMENT') 
-                                 | (settlement_df['amount-description'] == 'WAREHOUSE_DAMAGE') | (settlement_df['amount-description'] == 'WAREHOUSE_DAMAGE_EXCEPTION') 
-                                 | (settlement_df['amount-description'] == 'WAREHOUSE_LOST') |  (settlement_df['amount-description'] == 'WAREHOUSE_LOST_MANUAL') |   (settlement_df['amount-description'] == 'CS_ERROR_ITEMS')|
-                                    (settlement_df['amount-description'] == 'MISSING_FROM_INBOUND')]
+    ns_units = settlement_df.loc[select_descriptions(settlement_df, nonsales_unit_descriptions)]
     ns_units = ns_units[['sku', 'quantity-purchased']]
     #clawback_units =settlement_df.loc[ (settlement_df['amount-description'] == 'COMPENSATED_CLAWBACK') ]
     #clawback_units = clawback_units[['sku', 'quantity-purchased']]
@@ -59,6 +193,7 @@ def get_nonsales_units(settlement_df):
     #ns_units = ns_units['quantity-purchased'] - clawback_units['quantity-purchased']
     return ns_units.rename(columns={'quantity-purchased':'Non-Sale Units'})
 
+@profiled
 def get_merchantfulfilled_units(settlement_df):
     mf_units = settlement_df.loc[(settlement_df['fulfillment-id']== 'MFN') & (settlement_df['amount-description']=='Principal')]
     mf_units = mf_units[['sku', 'quantity-purchased']]
@@ -66,6 +201,7 @@ def get_merchantfulfilled_units(settlement_df):
     mf_units.loc[~(mf_units==0).all(axis=1)]
     return mf_units.rename(columns={'quantity-purchased':'Merchant Fulfilled Units'})
 
+@profiled
 def get_salesbased_revenue(settlement_df):
     '''returns the column for sales based revenue (only comission without fees'''
     sales_revenue = settlement_df.loc[(settlement_df['amount-description'] == 'Principal')]
@@ -73,12 +209,14 @@ def get_salesbased_revenue(settlement_df):
     sales_revenue = sales_revenue.groupby('sku').sum()
     return sales_revenue.rename(columns={'amount':'Sales Revenue'})
 
+@profiled
 def get_average_sales_price(settlement_df):
     units = get_units_sold(settlement_df)
     sales_revenue = get_salesbased_revenue(settlement_df)
     sales_revenue['Average Price'] =  sales_revenue['Sales Revenue'] / units['Units Sold']
     return sales_revenue['Average Price']
 
+@profiled
 def get_commission(settlement_df):
     '''Return comission Column'''
     commission = settlement_df.loc[(settlement_df['amount-description'] == 'Commission')]
@@ -86,6 +224,7 @@ def get_commission(settlement_df):
     commission = commission.groupby('sku').sum()
     return commission.rename(columns={'amount':'Commission'})
 
+@profiled
 def get_average_commision_per_unit(settlement_df):
     '''Returns Average Comission per Unit'''
     units = get_units_sold(settlement_df)
@@ -95,6 +234,7 @@ def get_average_commision_per_unit(settlement_df):
     commission['Commision Per Unit'] = commission['Commission'] / units['Units Sold']
     return commission['Commision Per Unit']
 
+@profiled
 def get_commission_percent(settlement_df):
     '''Returns Comission as a percent'''
     comission = get_commission(settlement_df)
@@ -102,14 +242,15 @@ def get_commission_percent(settlement_df):
     comission['Commission Percent'] = (comission['Commission']/ sales_revenue['Sales Revenue'])*-1
     return comission['Commission Percent']
 
+@profiled
 def get_fba_fees(settlement_df):
     '''Get all FBA fees'''
-    fba_fees = settlement_df.loc[(settlement_df['amount-description'] == 'FBAPerOrderFulfillmentFee') | (settlement_df['amount-description'] == 'FBAPerUnitFulfillmentFee')
-                                  | (settlement_df['amount-description'] == 'FBAWeightBasedFee') | (settlement_df['amount-description'] == 'FBAWeightBasedFee') ]
+    fba_fees = settlement_df.loc[select_descriptions(settlement_df, fba_fee_descriptions)]
     fba_fees = fba_fees[['sku', 'amount']]
     fba_fees = fba_fees.groupby('sku').sum()
     return fba_fees.rename(columns={'amount':'FBA Fees'})
 
+@profiled
 def get_average_fba_fees(settlement_df):
     '''Gets an average fba fee per units'''
     units = get_units_sold(settlement_df)
@@ -117,98 +258,106 @@ def get_average_fba_fees(settlement_df):
     fba_fees['FBA Fee Average'] = fba_fees['FBA Fees'] / units['Units Sold']
     return fba_fees['FBA Fee Average']
 
+@profiled
 def get_nonsales_revenue(settlement_df):
     '''Get revenue for the following: COMPENSATED_CLAWBACK, FREE_REPLACEMENT_REFUND_ITEMS, RefundCommission, RestockingFee, REVERSAL_REIMBURSEMENT,
     WAREHOUSE_DAMAGE, WAREHOUSE_DAMAGE_EXCEPTION, WAREHOUSE_LOST, WAREHOUSE_LOST_MANUAL '''
     #these are non sale revenue by SKU
-    ns_revenue = settlement_df.loc[(settlement_df['amount-description'] == 'COMPENSATED_CLAWBACK') | (settlement_df['amount-description'] == 'FREE_REPLACEMENT_REFUND_ITEMS')  
-                                   |(settlement_df['amount-description'] == 'RefundCommission') | (settlement_df['amount-description'] == 'REVERSAL_REIMBURSEMENT') | (settlement_df['amount-description'] == 'WAREHOUSE_DAMAGE')
-                                    | (settlement_df['amount-description'] == 'WAREHOUSE_DAMAGE_EXCEPTION') | (settlement_df['amount-description'] == 'WAREHOUSE_LOST') 
-                                    |  (settlement_df['amount-description'] == 'WAREHOUSE_LOST_MANUAL') | (settlement_df['amount-description'] == 'VariableClosingFee') 
-                                    | (settlement_df['amount-description'] == 'ShippingChargeback') 
-                                    | (settlement_df['amount-description'] == 'Shipping') 
-                                    | (settlement_df['amount-description'] == 'MISSING_FROM_INBOUND') 
-                                    | (settlement_df['amount-description'] == 'CS_ERROR_ITEMS')  
-                                    | (settlement_df['amount-description'] == 'Goodwill') 
-                                    | (settlement_df['amount-description'] == 'ShippingHB') 
-                                    | (settlement_df['amount-description'] == 'RestockingFee')]
+    ns_revenue = settlement_df.loc[select_descriptions(settlement_df, nonsales_revenue_descriptions)]
     ns_revenue = ns_revenue[['sku', 'amount']]
     ns_revenue = ns_revenue.groupby('sku').sum()
     return ns_revenue.rename(columns={'amount':'Non-Sales Revenue'})
 
+@profiled
 def get_non_skus(settlement_df):
     '''Gets line items without a SKU  from the flat file. Such as Subscription, Monthly Storage, Reserve, Etc'''
-    nonskus= settlement_df.loc[(settlement_df['amount-description'] == 'Subscription Fee')|
-    (settlement_df['amount-description'] == 'Previous Reserve Amount Balance') | (settlement_df['amount-description'] == 'Current Reserve Amount') |
-    (settlement_df['amount-description'] == 'RemovalComplete') | (settlement_df['amount-description'] == 'Adjustment')|
-    (settlement_df['amount-description'] == 'DisposalComplete') | (settlement_df['amount-description'] == 'FBACustomerReturnPerUnitFee') |
-    (settlement_df['amount-description'] == 'Shipping label purchase') | (settlement_df['amount-description'] == 'Shipping label purchase for return') |
-    (settlement_df['amount-description'] == 'INCORRECT_FEES_NON_ITEMIZED') | (settlement_df['amount-description'] == 'FBAInboundTransportationFee')|
-    (settlement_df['amount-description'] == 'FBA Pick & Pack Fee') |
-    (settlement_df['amount-description'] == 'StorageRenewalBilling')  |
-    (settlement_df['amount-description'] == 'Manual Processing Fee')  |
-    (settlement_df['amount-description'] == 'Manual Processing Fee Reimbursement')  |
-    (settlement_df['amount-description'] == 'NonSubscriptionFeeAdj')]
-    nonskus = nonskus[['amount-description', 'amount']]
-    nonskus = nonskus.groupby('amount-description').sum()
+    return non_skus_from_totals(get_description_totals(settlement_df))
+
+@profiled
+def get_refund_metrics(settlement_df):
+    '''Returns refunded units and the refund amounts by SKU, bucketed by amount-description, from one masked pass
+    over the Refund rows. A refunded Principal row without a quantity counts as one unit'''
+    sku = as_category(settlement_df['sku'])
+    description = as_category(settlement_df['amount-description'])
+    transaction_type = as_category(settlement_df['transaction-type'])
+    descriptions = description.cat.categories
+    #trailing slot so that a -1 (missing) code lands on "no bucket"
+    refund_lookup = np.full(len(descriptions) + 1, refund_columns.index('Other Refund Charges'), dtype=np.int64)
+    refund_lookup[-1] = -1
+    for position, name in enumerate(descriptions):
+        if name in refund_buckets:
+            refund_lookup[position] = refund_columns.index(refund_buckets[name])
+    refund_type = np.append(transaction_type.cat.categories == 'Refund', False)
+    is_refund = refund_type[transaction_type.cat.codes.to_numpy()]
+    bucket_codes = np.where(is_refund, refund_lookup[description.cat.codes.to_numpy()], -1)
+    sku_codes = sku.cat.codes.to_numpy()
+    amounts = amount_cents(settlement_df)
+    refunds = sum_by_sku_and_bucket(sku_codes, bucket_codes, amounts, len(sku.cat.categories), len(refund_columns)) / 100
+    quantities = settlement_df['quantity-purchased'].astype('Float64').fillna(1).to_numpy(dtype=np.float64)
+    principal = bucket_codes == refund_columns.index('Refunded Sales')
+    units = sum_by_sku_and_bucket(sku_codes, np.where(principal, 0, -1), quantities, len(sku.cat.categories), 1)
+    refund_metrics = pd.DataFrame(refunds, index=pd.Index(sku.cat.categories, name='sku'), columns=refund_columns)
+    refund_metrics.insert(0, 'Refunded Units', np.rint(units[:, 0]).astype(np.int64))
+    return refund_metrics
+
+@profiled
+def get_description_totals(settlement_df):
+    '''Returns the amount summed by amount-description'''
+    description = as_category(settlement_df['amount-description'])
+    codes = description.cat.codes.to_numpy()
+    keep = codes >= 0
+    amounts = amount_cents(settlement_df)
+    totals = np.bincount(codes[keep], weights=amounts[keep], minlength=len(description.cat.categories)) / 100
+    return pd.Series(totals, index=pd.Index(description.cat.categories, name='amount-description'), name='amount')
+
+def non_skus_from_totals(description_totals):
+    '''Picks the line items without a SKU out of get_description_totals'''
+    nonskus = description_totals[description_totals.index.isin(non_sku_descriptions)].to_frame()
     nonskus = nonskus.rename(index={'StorageRenewalBilling':'Long-Term Storage Fee'})
     nonskus = nonskus.loc[~(nonskus==0).all(axis=1)]
     return nonskus
 
-def get_storage(settlement_df):
-    '''Gets storage Fee'''
-    storage_fee = settlement_df.loc[(settlement_df['amount-description'] == 'Storage Fee')]
-    storage_fee = storage_fee[['amount-description', 'amount']]
-    storage_fee = storage_fee['amount'].sum()
-    return storage_fee
-
-def monthly_storage_charged(settlement_df):
-    '''Returns True/False if monthly storaged was charged'''
-    return get_storage(settlement_df) != 0
-
-def lts_charged(settlement_df):
-    '''Returns if long term storage was charged'''
-    longterm_storage_fee = settlement_df.loc[(settlement_df['amount-description'] == 'StorageRenewalBilling')]
-    longterm_storage_fee = longterm_storage_fee[['amount-description', 'amount']]
-    longterm_storage_fee = longterm_storage_fee['amount'].sum()
-    return longterm_storage_fee != 0
-
-def get_lts_with_sku(lts_df):
-    '''Returns a data frame with long term storage by SKU'''
-    sku_fnsku = manage_fba_inventory_df[['sku', 'fnsku']]
-    sku_fnsku = sku_fnsku.groupby('fnsku').sum()
-    lts_storage = lts_df[['fnsku', 'amount-charged']]
-    lts_storage = lts_storage.groupby('fnsku').sum()
-    lts_by_sku= pd.concat((sku_fnsku, lts_storage), axis=1)
-    lts_by_sku = lts_by_sku[lts_by_sku['amount-charged'].notna()]
-    lts_by_sku = lts_by_sku.rename(columns={'amount-charged':'LTS Fee'})
-    lts_by_sku = lts_by_sku.groupby('sku').sum() * -1
-    return lts_by_sku
-
-def get_storage_with_sku(monthly_storage_df, manage_fba_inventory_df):
-    '''Returns a data frame with monthly storage by SKU'''
-    sku_fnsku = manage_fba_inventory_df[['sku', 'fnsku']]
-    sku_fnsku = sku_fnsku.groupby('fnsku').sum()
-    monthly_storage = monthly_storage_df[['fnsku', 'estimated_monthly_storage_fee']]
-    monthly_storage = monthly_storage.groupby('fnsku').sum()
-    storage_by_sku = pd.concat((sku_fnsku, monthly_storage), axis=1)
-    storage_by_sku = storage_by_sku[storage_by_sku['estimated_monthly_storage_fee'].notna()]
-    storage_by_sku = storage_by_sku.rename(columns={'estimated_monthly_storage_fee':'Storage Fee'})
-    return (storage_by_sku.groupby('sku').sum() * -1)
-
-def get_asin_and_title(manage_fba_inventory_df):
-    '''Returns the ASIN and Title of the SKUS based on FBA Archive'''
-    asins_and_skus_df = manage_fba_inventory_df[['sku', 'asin', 'product-name']]
-    asins_and_skus_df = asins_and_skus_df.groupby('sku').sum()
+def summary_storage_charged(summary):
+    '''Returns True/False if monthly storage was charged, from a settlement summary'''
+    return summary['description_totals'].get('Storage Fee', 0) != 0
+
+def summary_lts_charged(summary):
+    '''Returns if long term storage was charged, from a settlement summary'''
+    return summary['description_totals'].get('StorageRenewalBilling', 0) != 0
+
+def summary_subscription_charged(summary):
+    '''Returns if the seller subscription was charged, from a settlement summary'''
+    return summary['description_totals'].get('Subscription Fee', 0) != 0
+
+@profiled
+def get_lts_with_sku(lts_df, manage_fba_inventory):
+    '''Returns a data frame with long term storage by SKU. Takes the FBA archive or its InventoryIndex'''
+    inventory = as_inventory_index(manage_fba_inventory)
+    lts_by_sku = inventory.allocate_by_fnsku(lts_df['fnsku'], lts_df['amount-charged'])
+    return lts_by_sku.to_frame('LTS Fee') * -1
+
+@profiled
+def get_storage_with_sku(monthly_storage_df, manage_fba_inventory):
+    '''Returns a data frame with monthly storage by SKU. Takes the FBA archive or its InventoryIndex'''
+    inventory = as_inventory_index(manage_fba_inventory)
+    storage_by_sku = inventory.allocate_by_fnsku(monthly_storage_df['fnsku'], monthly_storage_df['estimated_monthly_storage_fee'])
+    return storage_by_sku.to_frame('Storage Fee') * -1
+
+@profiled
+def get_asin_and_title(manage_fba_inventory):
+    '''Returns the ASIN and Title of the SKUS based on FBA Archive. Takes the FBA archive or its InventoryIndex'''
+    asins_and_skus_df = as_inventory_index(manage_fba_inventory).asin_and_title_table()
     asins_and_skus_df['product-name'] = asins_and_skus_df['product-name'].str[:40]
     return asins_and_skus_df
 
+@profiled
 def get_advertising_spend(advertising_df):
     '''Gets the spend of advertising by SKU'''
     advertising_by_sku = advertising_df[['Advertised SKU', 'Spend']]
     advertising_by_sku = advertising_by_sku.rename(columns={"Advertised SKU": 'sku', 'Spend': 'Advertising Spend'})
     return advertising_by_sku.groupby('sku').sum() * -1
 
+@profiled
 def get_cost(helium10_df):
     cost = helium10_df[['SKU','PRODUCT COST', 'SHIPPING COST']]
     cost = cost.rename(columns={"SKU": 'sku', 'PRODUCT COST': 'Product Cost', 'SHIPPING COST': 'Packing Cost'})
@@ -218,21 +367,36 @@ def get_cost(helium10_df):
     cost.drop(index_dropping, inplace=True)
     return cost
 
-def main_table(settlement_df):
-    '''Returns a dataframe consisting of all columns'''
-    settlement_analysis = pd.concat([asins_and_skus_df, get_units_sold(settlement_df), get_nonsales_units(settlement_df), get_merchantfulfilled_units(settlement_df)], axis=1)
+def main_table(settlement_df, asins_and_skus_df, storage_sku_df=None, lts_sku_df=None, advertising_spend=None, product_cost_df=None):
+    '''Returns a dataframe consisting of all columns. Storage, LTS, advertising and cost columns are added when their frame is given'''
+    return build_main_table(get_sku_metrics(settlement_df), asins_and_skus_df, storage_sku_df, lts_sku_df, advertising_spend, product_cost_df)
+
+@profiled
+def build_main_table(sku_metrics, asins_and_skus_df, storage_sku_df=None, lts_sku_df=None, advertising_spend=None, product_cost_df=None):
+    '''Same as main_table, but from already aggregated get_sku_metrics columns'''
+    adding_storage = storage_sku_df is not None
+    adding_advertising = advertising_spend is not None
+    adding_cost = product_cost_df is not None
+    settlement_analysis = pd.concat([asins_and_skus_df, sku_metrics[unit_columns]], axis=1)
     settlement_analysis['Total Units'] = settlement_analysis['Units Sold'] + settlement_analysis['Non-Sale Units'] + settlement_analysis['Merchant Fulfilled Units']
-    settlement_analysis = pd.concat([settlement_analysis, get_salesbased_revenue(settlement_df), get_commission(settlement_df), get_commission_percent(settlement_df), get_average_commision_per_unit(settlement_df),get_fba_fees(settlement_df), get_average_fba_fees(settlement_df), get_nonsales_revenue(settlement_df), get_average_sales_price(settlement_df)], axis=1)
+    settlement_analysis['Sales Revenue'] = sku_metrics['Sales Revenue']
+    settlement_analysis['Commission'] = sku_metrics['Commission']
+    settlement_analysis['Commission Percent'] = (sku_metrics['Commission'] / sku_metrics['Sales Revenue']) * -1
+    settlement_analysis['Commision Per Unit'] = sku_metrics['Commission'] / sku_metrics['Units Sold']
+    settlement_analysis['FBA Fees'] = sku_metrics['FBA Fees']
+    settlement_analysis['FBA Fee Average'] = sku_metrics['FBA Fees'] / sku_metrics['Units Sold']
+    settlement_analysis['Non-Sales Revenue'] = sku_metrics['Non-Sales Revenue']
+    settlement_analysis['Average Price'] = sku_metrics['Sales Revenue'] / sku_metrics['Units Sold']
     settlement_analysis['Amazon Revenue'] = settlement_analysis['Sales Revenue'] + settlement_analysis['Commission'] + settlement_analysis['FBA Fees'] + settlement_analysis['Non-Sales Revenue'] 
     settlement_analysis['Amazon Revenue'] = settlement_analysis['Amazon Revenue'].fillna(0)
-    if monthly_storage_charged(settlement_df):
+    if adding_storage:
         settlement_analysis = pd.concat([settlement_analysis, storage_sku_df], axis=1)
         settlement_analysis['Storage Fee'] = settlement_analysis['Storage Fee'].fillna(0)
         #settlement_analysis = settlement_analysis.dropna(subset=['Storage Fee'])
     if adding_advertising:
         settlement_analysis = pd.concat([settlement_analysis, advertising_spend], axis=1)
         settlement_analysis['Advertising Spend'] = settlement_analysis['Advertising Spend'].fillna(0)
-        if monthly_storage_charged(settlement_df):
+        if adding_storage:
             settlement_analysis['Total Return'] = settlement_analysis['Amazon Revenue'] + settlement_analysis['Storage Fee'] + settlement_analysis['Advertising Spend']
             settlement_analysis['Total (w/o Advertising)'] = settlement_analysis['Amazon Revenue'] + settlement_analysis['Storage Fee'] 
         else:
@@ -241,11 +405,11 @@ def main_table(settlement_df):
         index_dropping = settlement_analysis[(settlement_analysis['Amazon Revenue'] ==0) & (settlement_analysis['Advertising Spend'] ==0) & (settlement_analysis['Total Return'] ==0)].index
         settlement_analysis.drop(index_dropping, inplace=True)
     else:
-        if monthly_storage_charged(settlement_df):
+        if adding_storage:
             settlement_analysis['Total Return'] = settlement_analysis['Amazon Revenue'] + settlement_analysis['Storage Fee'] 
         else:
             settlement_analysis['Total Return'] = settlement_analysis['Amazon Revenue']
-    if lts_charged(settlement_df):
+    if lts_sku_df is not None:
         settlement_analysis = pd.concat([settlement_analysis, lts_sku_df], axis=1)
         #settlement_analysis.to_csv("debug.csv")
         #print(settlement_analysis.columns.tolist())
@@ -280,53 +444,83 @@ def main_table(settlement_df):
     settlement_analysis.replace([np.inf, -np.inf], np.nan, inplace=True)
     return  rename_columns(settlement_analysis)
 
+#family rules picked up by the file dialog flow
+default_sku_families = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sku_families.json')
+
+#main table columns that can be added up across SKUs or settlements
+summed_columns = ['Units Sold', 'Non-Sale Units', 'Merchant Fulfilled Units', 'Total Units', 'Sales Revenue', 'Commission',
+    'FBA Fees', 'Non-Sales Revenue', 'Amazon Revenue', 'Storage Fee', 'Advertising Spend', 'Total Return',
+    'Total (w/o Advertising)', 'LTS Fee', 'Total Cost', 'Cost (w/ Advertising', 'Total Profit']
+
+def add_ratio_columns(analysis):
+    '''Recomputes the per-unit, percent and ROI columns from the summed columns'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        analysis['Commission Percent'] = analysis['Commission'] / analysis['Sales Revenue'] * -1
+        analysis['Commision Per Unit'] = analysis['Commission'] / analysis['Units Sold']
+        analysis['FBA Fee Average'] = analysis['FBA Fees'] / analysis['Units Sold']
+        analysis['Average Price'] = analysis['Sales Revenue'] / analysis['Units Sold']
+        analysis['Return Per Unit'] = analysis['Total Return'] / analysis['Total Units']
+        if 'Total (w/o Advertising)' in analysis:
+            analysis['Return Per Unit (w/o Advertising)'] = analysis['Total (w/o Advertising)'] / analysis['Total Units']
+        if 'Total Cost' in analysis:
+            analysis['Cost Per Unit'] = analysis['Total Cost'] / analysis['Total Units'] * -1
+            analysis['ROI'] = analysis['Total Profit'] / analysis['Total Cost'] * -1
+            if 'Cost (w/ Advertising' in analysis:
+                analysis['ROI w/ advertising'] = analysis['Total Profit'] / analysis['Cost (w/ Advertising'] * -1
+                analysis['ROI Difference'] = analysis['ROI w/ advertising'] - analysis['ROI']
+    return analysis.replace([np.inf, -np.inf], np.nan)
+
+#main table column -> shorter name used in the report
+short_column_names = {
+    "product-name": "Title",
+    "Non-Sale Units": "N/S Units",
+    "Merchant Fulfilled Units": "MF Units",
+    "Total Units": "Total",
+    "Commission": "Comm",
+    "Commission Percent": "Comm %",
+    "Commision Per Unit": "Comm/Unit",
+    "FBA Fee Average": "Fee Avg",
+    "Non-Sales Revenue": "N/S Rev",
+    "Average Price": "Avg Price",
+    "Amazon Revenue": "Amz Rev",
+    "Return Per Unit": "Return/Unit",
+    "Advertising Spend": "Ad Spend",
+    #storage
+    "Storage Fee": "Storage",
+    #advertising
+    "Total (w/o Advertising)": "Total before Ads",
+    "Return Per Unit (w/o Advertising)": "Return/unit before Ads",
+    #cost
+    "Product Cost": "Cost",
+    "Packing Cost:": "Packing",
+    "Cost Per Unit": "COGS",
+    "Total Cost": "Total COGS"}
+
 def rename_columns(settlement_analysis):
-    new_df = settlement_analysis
-    new_df = new_df.rename(columns={
-        "product-name": "Title",
-        "Non-Sale Units": "N/S Units",
-        "Merchant Fulfilled Units": "MF Units",
-        "Total Units": "Total",
-        "Commission": "Comm",
-        "Commission Percent": "Comm %",
-        "Commision Per Unit": "Comm/Unit",
-        "FBA Fee Average": "Fee Avg",
-        "Non-Sales Revenue": "N/S Rev",
-        "Average Price": "Avg Price",
-        "Amazon Revenue": "Amz Rev",
-        "Return Per Unit": "Return/Unit",
-        "Advertising Spend": "Ad Spend"})
-    if monthly_storage_charged(settlement_df):
-        new_df = new_df.rename(columns={
-        "Storage Fee": "Storage"})
-    if adding_advertising:
-        new_df = new_df.rename(columns={
-        "Total (w/o Advertising)": "Total before Ads",
-        "Return Per Unit (w/o Advertising)": "Return/unit before Ads"})
-    if adding_cost:
-        new_df = new_df.rename(columns={
-        "Product Cost": "Cost",
-        "Packing Cost:": "Packing",
-        "Cost Per Unit": "COGS",
-        "Total Cost": "Total COGS"})
-    #make sure to rename columns differently if adding cost/advertising
-    return new_df
-
-def get_overview(settlement_df):
+    '''Shortens column names for the report. Storage, advertising and cost names are only present when those were added'''
+    return settlement_analysis.rename(columns=short_column_names)
+
+def restore_column_names(main_df):
+    '''Undoes rename_columns, giving back the main table with its full column names'''
+    return main_df.rename(columns={short: full for full, short in short_column_names.items()})
+
+def get_overview(settlement_df, main_df, storage_sku_df=None, advertising_spend=None):
     '''Returns a dataframe with totals for everything'''
-    disbursement_total = settlement_df['amount'].sum()
-    main_df = main_table(settlement_df)
-    non_sku_df = get_non_skus(settlement_df)
+    return build_overview(get_non_skus(settlement_df), main_df, storage_sku_df, advertising_spend)
+
+@profiled
+def build_overview(non_sku_df, main_df, storage_sku_df=None, advertising_spend=None):
+    '''Same as get_overview, but from already aggregated get_non_skus rows'''
     amazon_revenue = main_df['Amz Rev'].sum()
     overview ={
         #'Disbursement Total': disbursement_total,
         'Amazon Revenue': amazon_revenue
     }
-    if monthly_storage_charged(settlement_df):
-        storage_fee = storage_sku_df.sum()[0]
+    if storage_sku_df is not None:
+        storage_fee = storage_sku_df['Storage Fee'].sum()
         overview['Storage Fee'] = storage_fee
-    if adding_advertising:
-        advertising_total = advertising_spend.sum()[0]
+    if advertising_spend is not None:
+        advertising_total = advertising_spend['Advertising Spend'].sum()
         overview['Advertising Total'] = advertising_total
     overview = pd.DataFrame.from_dict(overview,orient='index', columns=['amount'])
     overview = pd.concat([overview, non_sku_df])
@@ -336,198 +530,527 @@ def get_non_sale_revenue_tab(settlement_df):
     '''Makes a dataframe for non-sale revenue (units and revenue)'''
     return True
 
-def filter_niro_skus(final_table_df):
-    return final_table_df.filter(like = 'NIRO', axis=0)
+def load_sku_families(path):
+    '''Reads SKU family rules from a json file: a list of {"family": name} with one of "prefix", "contains", "regex" or "skus" (list).
+    A SKU belongs to the first family whose rule matches'''
+    with open(path) as f:
+        return json.load(f)
 
-def filter_hd_skus(final_table_df):
-    return final_table_df.filter(like = 'HD', axis=0)
+def family_rule_pattern(rule):
+    '''Returns a lookahead that matches at the start of a SKU when the rule does'''
+    if 'prefix' in rule:
+        return '(?=' + re.escape(rule['prefix']) + ')'
+    if 'contains' in rule:
+        return '(?=.*' + re.escape(rule['contains']) + ')'
+    if 'regex' in rule:
+        return '(?=.*?(?:' + rule['regex'] + '))'
+    if 'skus' in rule:
+        return '(?=(?:' + '|'.join(re.escape(sku) for sku in rule['skus']) + ')$)'
+    raise ValueError('SKU family rule needs prefix, contains, regex or skus: ' + repr(rule))
 
-def filter_other_skus(final_table_df):
-    return final_table_df.filter(regex = r'MD|MED', axis=0)
+def classify_skus(skus, sku_families):
+    '''Returns the family of every SKU as a categorical, "Unassigned" when no rule matches.
+    All rules go into one regex (alternatives are tried in rule order), so each SKU is scanned once'''
+    families = [rule['family'] for rule in sku_families]
+    categories = list(dict.fromkeys(families + ['Unassigned']))
+    if not sku_families:
+        return pd.Categorical.from_codes(np.zeros(len(skus), dtype=np.int64), categories=categories)
+    pattern = '^(?:' + '|'.join('(?P<rule' + str(position) + '>' + family_rule_pattern(rule) + ')' for position, rule in enumerate(sku_families)) + ')'
+    matches = pd.Series(skus, dtype=object).astype(str).str.extract(pattern)
+    #the one matching alternative has an empty string, the others NaN. Groups inside a regex rule are left out
+    matched = matches[['rule' + str(position) for position in range(len(sku_families))]].notna().to_numpy()
+    rule_numbers = np.where(matched.any(axis=1), matched.argmax(axis=1), len(families))
+    codes = np.array([categories.index(family) for family in families + ['Unassigned']])[rule_numbers]
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+@profiled
+def add_sku_families(tabs, sku_families):
+    '''Adds a Family column to the Sales tab and a tab per family (with a subtotal row) built from one groupby'''
+    sales = tabs['Sales'].copy()
+    sales['Family'] = classify_skus(sales.index, sku_families)
+    family_tabs = {}
+    for family, family_df in sales.groupby('Family', observed=True, sort=True):
+        family_df = family_df.drop(columns='Family')
+        family_tabs[family] = pd.concat([family_df, get_subtotal_row(family_df)])
+    tabs = dict(tabs)
+    tabs['Sales'] = sales
+    for family, family_df in family_tabs.items():
+        #a family named like a report tab (Sales, Overview, Refunds) must not replace it
+        tabs[family + ' Family' if family in tabs else family] = family_df
+    return tabs
+
+def get_subtotal_row(main_df, label='Subtotal'):
+    '''Returns a one row frame adding up main_df, with the ratio columns recomputed from the totals'''
+    totals = restore_column_names(main_df)
+    summed = [column for column in summed_columns if column in totals]
+    subtotal = add_ratio_columns(totals[summed].sum().to_frame(label).T)
+    return rename_columns(subtotal)
 
 def get_refunds(settlement_df, final_table_df):
     '''Returns a dataframe showing transcation type refund only'''
-    refund_df = settlement_df.loc[settlement_df['transaction-type'] == 'Refund']
-    refund_df = refund_df.groupby('sku').sum()
-    refund_df = refund_df["amount"]
-    refund_df = refund_df.rename("Refund Total")
-    total_sales_df = final_table_df['Sales Revenue']
-    refund_df = pd.concat([refund_df, total_sales_df], axis=1)
-    refund_df = refund_df.replace(to_replace=0, value=np.nan)
-    refund_df = refund_df.dropna(subset=["Refund Total"])
-    refund_df['Refund Total'] = refund_df['Refund Total'] * -1
-    refund_df['Refund Percentage of Sales'] = refund_df['Refund Total'] / refund_df['Sales Revenue']
-    refund_df = refund_df.sort_values(by='Refund Percentage of Sales', ascending=False)
-    return refund_df
+    return build_refund_tab(get_refund_metrics(settlement_df), final_table_df)
+
+@profiled
+def build_refund_tab(refund_metrics, main_df):
+    '''Returns the refund tab of the SKUs with refunds. Units sold and sales revenue are taken from the main table
+    so the refund rates match the Sales tab'''
+    refund_df = refund_metrics.loc[(refund_metrics != 0).any(axis=1)].copy()
+    refund_df['Refund Total'] = refund_df[refund_columns].sum(axis=1)
+    sales = main_df.reindex(refund_df.index)[['Units Sold', 'Sales Revenue']].fillna(0)
+    refund_df['Units Sold'] = sales['Units Sold'].astype(np.int64)
+    refund_df['Sales Revenue'] = sales['Sales Revenue']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        refund_df['Refund Rate (Units)'] = refund_df['Refunded Units'] / refund_df['Units Sold']
+        refund_df['Refund Rate (Revenue)'] = refund_df['Refunded Sales'] / refund_df['Sales Revenue'] * -1
+    refund_df = refund_df.replace([np.inf, -np.inf], np.nan)
+    return refund_df.sort_values('Refund Rate (Revenue)', ascending=False)
     
+@profiled
 def get_statement_period(settlement_df):
-    '''Returns a list with start and end date'''
-    dates = settlement_df [settlement_df ['settlement-start-date'].notna()][['settlement-start-date', 'settlement-end-date']] 
-    statement_start_date = dates.iloc[0][0]
-    statement_end_date = dates.iloc[0][1]
+    '''Returns a list with start and end date, None if the rows given have no dates'''
+    has_dates = settlement_df['settlement-start-date'].notna().to_numpy()
+    if not has_dates.any():
+        return None
+    #the summary row at the top of the flat file has the dates
+    position = has_dates.argmax()
+    statement_start_date = settlement_df['settlement-start-date'].iloc[position]
+    statement_end_date = settlement_df['settlement-end-date'].iloc[position]
     statement_period = [statement_start_date, statement_end_date]
     return statement_period
 
-def export_report(filename):
-    '''Export to Excel with multiple Worksheets. Uses settlement report date as suffix'''
-    report_date_range = get_statement_period(settlement_df)
+def parse_settlement_date(date):
+    '''Returns a settlement date as a UTC Timestamp. EU flat files write dates as dd.mm.yyyy, so they are not compared as strings'''
+    return pd.to_datetime(date, dayfirst='.' in str(date)[:10], utc=True)
+
+def get_first_value(settlement_df, column):
+    '''Returns the first non-empty value of a column as a string, None if there is none'''
+    values = settlement_df[column].dropna()
+    if values.empty:
+        return None
+    return str(values.iloc[0])
+
+def get_settlement_id(settlement_df):
+    '''Returns the settlement-id of the first row that has one, None if there is none'''
+    return get_first_value(settlement_df, 'settlement-id')
+
+def get_transaction_counts(settlement_df):
+    '''Returns the number of rows of each transaction-type'''
+    transaction_type = as_category(settlement_df['transaction-type'])
+    codes = transaction_type.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(transaction_type.cat.categories))
+    return pd.Series(counts, index=pd.Index(transaction_type.cat.categories, name='transaction-type'), name='rows')
+
+@profiled
+def export_report(filename, report_date_range, tabs, formats=('xlsx',)):
+    '''Export to Excel with a Worksheet per tab (Sales, Overview, then any others), and/or a CSV or Parquet file per tab.
+    Uses settlement report date (get_statement_period) as suffix. Returns the files written'''
     start_date = report_date_range[0]
     start_date = start_date[:10]
     end_date = report_date_range[1]
     end_date = end_date[:10]
     filename = filename + "_" + start_date + "_to_" + end_date
-    writer = pd.ExcelWriter(filename + ".xlsx", engine='xlsxwriter')
-    finalized_report.to_excel(writer, sheet_name='Sales')
-    overview_tab.to_excel(writer, sheet_name='Overview')
-    #turning off other tabs for now
-    #niro_tab.to_excel(writer, sheet_name='NIRO')
-    #hd_tab.to_excel(writer, sheet_name='HD')
-    #other_tab.to_excel(writer, sheet_name='Other')
-    #refund_tab.to_excel(writer, sheet_name="Refunds")
-    writer.close()
-
-flatfile_form = sg.FlexForm('Settlement Analyzer') 
-layout = [
-          [sg.Text('Please select Flat File (v2)')],
-          [sg.Text('Statement File: ', size=(50, 1)), sg.FileBrowse()],
-          [sg.Submit(), sg.Cancel()]
-         ]
-button, filename = flatfile_form.Layout(layout).Read() 
-flat_file = filename['Browse']
-flatfile_form.close()
-settlement_df = pd.read_csv(flat_file, sep='\t', dtype=dtypes)
-#invoiced_form = sg.FlexForm('Settlement Analyzer') 
-#layout = [
-#          [sg.Text('Would you like to add invoiced orders too?')],
-#          [sg.Radio("Yes", "Radio1", default=False)], 
-#          [sg.Radio("No", "Radio2", default=False)],
-#          [sg.Submit(), sg.Cancel()]
-#         ]
-#button, add_invoiced =  invoiced_form.Layout(layout).Read() 
-#invoiced_form.close()
-#adding_invoiced = add_invoiced[0] 
-adding_invoiced = False
-if adding_invoiced:
-    get_invoiced_form = sg.FlexForm('Settlement Analyzer') 
+    return write_report(filename, tabs, formats)
+
+def is_flat_file(path):
+    '''Returns True if the file starts with the settlement flat file (v2) header'''
+    try:
+        with open(path, 'r', encoding='latin1') as f:
+            return f.readline().startswith('settlement-id\t')
+    except OSError:
+        return False
+
+def find_flat_files(folder):
+    '''Returns every settlement flat file in a folder, sorted by name'''
+    paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+    return [path for path in paths if os.path.isfile(path) and is_flat_file(path)]
+
+@profiled
+def read_settlement(flat_file, columns=None):
+    '''Reads a settlement flat file (v2). Only the columns the report is built from (summary_columns) are loaded
+    unless others are asked for, settlement_columns for all of them'''
+    schema = settlement_dtypes(summary_columns if columns is None else columns)
+    return cached_read(flat_file, 'settlement', lambda path: pd.read_csv(path, sep='\t', usecols=list(schema), dtype=schema), schema)
+
+@profiled
+def read_invoiced(invoiced_file, columns=None):
+    '''Reads an invoiced flat file (v2) without its total amount/date row'''
+    schema = settlement_dtypes(summary_columns if columns is None else columns)
+    invoice_df = cached_read(invoiced_file, 'settlement', lambda path: pd.read_table(path, sep='\t', usecols=list(schema), dtype=schema), schema)
+    return invoice_df.drop(index=0)
+
+def count_lines(path, block_size=1024 * 1024):
+    '''Counts the lines of a file without parsing it'''
+    lines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            lines += block.count(b'\n')
+    return lines
+
+def schema_memory_report(flat_file, sample_rows=None):
+    '''Returns the memory (MB by column) of a settlement loaded whole with the original dtypes against loaded the way
+    read_settlement does it. With sample_rows only the first rows are measured and scaled to the whole file, which
+    overstates near-unique category columns'''
+    full = pd.read_csv(flat_file, sep='\t', dtype=dtypes, nrows=sample_rows)
+    schema = settlement_dtypes(summary_columns)
+    compact = pd.read_csv(flat_file, sep='\t', usecols=list(schema), dtype=schema, nrows=sample_rows)
+    scale = max(count_lines(flat_file) - 1, 1) / max(len(full), 1) if sample_rows else 1
+    report = pd.DataFrame({'Full MB': full.memory_usage(index=False, deep=True), 'Compact MB': compact.memory_usage(index=False, deep=True)})
+    report = report.fillna(0) * scale / 2 ** 20
+    report['Saved MB'] = report['Full MB'] - report['Compact MB']
+    report.index.name = 'column'
+    report.loc['Total'] = report.sum()
+    return report
+
+@profiled
+def read_fba_archive(fba_inventory_report):
+    '''Reads the FBA Inventory Archive report'''
+    return cached_read(fba_inventory_report, 'fba-archive', lambda path: pd.read_csv(path, encoding='latin1'))
+
+@profiled
+def read_monthly_storage(storage_report):
+    '''Reads the Monthly Storage Fee report'''
+    return cached_read(storage_report, 'storage', lambda path: pd.read_csv(path, encoding='latin1'))
+
+@profiled
+def read_lts(lts_report):
+    '''Reads the Long-Term Storage (Inventory Surcharge) report'''
+    return cached_read(lts_report, 'lts', lambda path: pd.read_csv(path, encoding='latin1'))
+
+@profiled
+def read_advertising(advertising_report):
+    '''Reads the Sponsored Products advertised product report'''
+    return cached_read(advertising_report, 'advertising', pd.read_excel)
+
+@profiled
+def read_cost(helium10):
+    '''Reads the formatted Helium10 cost.csv'''
+    return cached_read(helium10, 'cost', pd.read_csv)
+
+@profiled
+def summarize_settlement(settlement_df):
+    '''Returns the per-SKU and per-description totals the report is built from, with the settlement's
+    metadata (see settlement_metadata), so nothing has to rescan the rows afterwards'''
+    description_totals = get_description_totals(settlement_df)
+    return {
+        'settlement_id': get_settlement_id(settlement_df),
+        'statement_period': get_statement_period(settlement_df),
+        'currency': get_first_value(settlement_df, 'currency'),
+        'rows': len(settlement_df),
+        'transaction_counts': get_transaction_counts(settlement_df),
+        'sku_metrics': get_sku_metrics(settlement_df),
+        'refund_metrics': get_refund_metrics(settlement_df),
+        'description_totals': description_totals,
+    }
+
+def combine_summaries(summaries):
+    '''Adds up summaries of parts of a settlement. The settlement-id and statement period come from the first part that has one'''
+    statement_period = next((summary['statement_period'] for summary in summaries if summary['statement_period']), None)
+    settlement_id = next((summary['settlement_id'] for summary in summaries if summary['settlement_id']), None)
+    currency = next((summary['currency'] for summary in summaries if summary['currency']), None)
+    sku_metrics = pd.concat([summary['sku_metrics'] for summary in summaries]).groupby(level=0).sum()
+    refund_metrics = pd.concat([summary['refund_metrics'] for summary in summaries]).groupby(level=0).sum()
+    description_totals = pd.concat([summary['description_totals'] for summary in summaries]).groupby(level=0).sum()
+    transaction_counts = pd.concat([summary['transaction_counts'] for summary in summaries]).groupby(level=0).sum()
+    sku_metrics.index.name = 'sku'
+    refund_metrics.index.name = 'sku'
+    description_totals.index.name = 'amount-description'
+    transaction_counts.index.name = 'transaction-type'
+    return {
+        'settlement_id': settlement_id,
+        'statement_period': statement_period,
+        'currency': currency,
+        'rows': sum(summary['rows'] for summary in summaries),
+        'transaction_counts': transaction_counts,
+        'sku_metrics': sku_metrics,
+        'refund_metrics': refund_metrics,
+        'description_totals': description_totals,
+    }
+
+def settlement_metadata(summary):
+    '''Returns what a settlement is without building the report: its id, period, currency, row counts and
+    whether (and how much) storage, long-term storage and the subscription were charged'''
+    description_totals = summary['description_totals']
+    return {
+        'settlement_id': summary['settlement_id'],
+        'statement_period': summary['statement_period'],
+        'currency': summary['currency'],
+        'rows': int(summary['rows']),
+        'rows_by_transaction_type': {str(name): int(count) for name, count in summary['transaction_counts'].items() if count},
+        'skus': int(len(summary['sku_metrics'])),
+        'storage_charged': bool(summary_storage_charged(summary)),
+        'storage_fee': float(description_totals.get('Storage Fee', 0)),
+        'lts_charged': bool(summary_lts_charged(summary)),
+        'lts_fee': float(description_totals.get('StorageRenewalBilling', 0)),
+        'subscription_charged': bool(summary_subscription_charged(summary)),
+        'subscription_fee': float(description_totals.get('Subscription Fee', 0)),
+    }
+
+def inspect_settlement(flat_file, chunksize=1000000):
+    '''Streams only the summary columns of a flat file and returns its settlement_metadata'''
+    return settlement_metadata(read_settlement_summary(flat_file, chunksize))
+
+@profiled
+def read_settlement_summary(flat_file, chunksize=1000000, skip_first_row=False):
+    '''Streams a flat file (v2) in chunks, keeping only the columns the report needs, and adds up each chunk's summary.
+    Memory is bounded by the chunk size and the number of SKUs, not by the size of the file'''
+    chunks = pd.read_csv(flat_file, sep='\t', usecols=summary_columns, dtype={column: dtypes[column] for column in summary_columns}, chunksize=chunksize)
+    partials = []
+    for chunk in chunks:
+        if skip_first_row:
+            chunk = chunk.iloc[1:]
+            skip_first_row = False
+        partials.append(summarize_settlement(chunk))
+        #keep the number of partial frames small on very large files
+        if len(partials) == 32:
+            partials = [combine_summaries(partials)]
+    return combine_summaries(partials)
+
+def analyze_settlement(settlement_df, manage_fba_inventory_df, monthly_storage_df=None, lts_df=None, advertising_df=None, helium10_df=None):
+    '''Builds the report tabs from already loaded reports. Returns a dict of tab name -> dataframe'''
+    return analyze_summary(summarize_settlement(settlement_df), manage_fba_inventory_df, monthly_storage_df, lts_df, advertising_df, helium10_df)
+
+@profiled
+def analyze_summary(summary, manage_fba_inventory_df, monthly_storage_df=None, lts_df=None, advertising_df=None, helium10_df=None):
+    '''Same as analyze_settlement, but from a summarize_settlement/read_settlement_summary summary'''
+    inventory = as_inventory_index(manage_fba_inventory_df)
+    asins_and_skus_df = get_asin_and_title(inventory)
+    storage_sku_df = None
+    lts_sku_df = None
+    advertising_spend = None
+    product_cost_df = None
+    if monthly_storage_df is not None and summary_storage_charged(summary):
+        storage_sku_df = get_storage_with_sku(monthly_storage_df, inventory)
+    if lts_df is not None and summary_lts_charged(summary):
+        lts_sku_df = get_lts_with_sku(lts_df, inventory)
+    if advertising_df is not None:
+        advertising_spend = get_advertising_spend(advertising_df)
+    if helium10_df is not None:
+        product_cost_df = get_cost(helium10_df)
+    finalized_report = build_main_table(summary['sku_metrics'], asins_and_skus_df, storage_sku_df, lts_sku_df, advertising_spend, product_cost_df)
+    overview_tab = build_overview(non_skus_from_totals(summary['description_totals']), finalized_report, storage_sku_df, advertising_spend)
+    refund_tab = build_refund_tab(summary['refund_metrics'], finalized_report)
+    return {'Sales': finalized_report, 'Overview': overview_tab, 'Refunds': refund_tab}
+
+def run_report(flat_file, fba_inventory_report, output_prefix, storage_report=None, lts_report=None, advertising_report=None, helium10=None, invoiced_file=None, chunksize=None, sku_families=None, formats=('xlsx',), threads=None):
+    '''Loads every report given, analyzes the settlement and exports it. Returns the files written.
+    With a chunksize the flat files are streamed instead of loaded whole'''
+    summary, tabs = load_and_analyze(flat_file, fba_inventory_report, storage_report, lts_report, advertising_report, helium10, invoiced_file, chunksize, sku_families, threads)
+    return export_report(output_prefix, summary['statement_period'], tabs, formats)
+
+#workbooks smaller than this parse in less time than a process takes to start
+process_read_min_bytes = 2 ** 20
+
+#the one spawned process read_in_process hands readers to, started on first use
+reader_process = None
+
+def read_in_process(reader, path):
+    '''Runs a reader in a process of its own. Used for the advertising workbook, whose pure Python parse would
+    otherwise hold the GIL the other parsers need. The process is spawned, not forked: this runs next to threads
+    that are parsing, and a fork of a multi-threaded process can deadlock. It is started once and reused.
+    Small workbooks, and reads from inside a batch or watch worker that is a process already, run in place'''
+    global reader_process
+    if multiprocessing.parent_process() is not None or os.path.getsize(path) < process_read_min_bytes:
+        return reader(path)
+    with profiling.stage(reader.__name__ + ' (process)'):
+        if reader_process is None:
+            reader_process = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        return reader_process.submit(reader, path).result()
+
+@profiled
+def load_reports(loaders, threads=None):
+    '''Runs every loader (name -> function without arguments) at once in a thread pool and returns name -> result.
+    The pandas CSV parser releases the GIL while tokenizing, so the text reports parse alongside each other
+    and loading takes about as long as the slowest report. threads=1 loads them one by one'''
+    if threads == 1 or len(loaders) < 2:
+        return {name: loader() for name, loader in loaders.items()}
+    with ThreadPoolExecutor(max_workers=threads or len(loaders)) as executor:
+        futures = {name: executor.submit(loader) for name, loader in loaders.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+@profiled
+def load_and_analyze(flat_file, fba_inventory_report, storage_report=None, lts_report=None, advertising_report=None, helium10=None, invoiced_file=None, chunksize=None, sku_families=None, threads=None, summary=None, columns=None):
+    '''Loads every report given and analyzes the settlement. Returns the settlement summary and the report tabs.
+    sku_families is the path of a family rules file (see load_sku_families). summary, if given, is the flat file's
+    read_settlement_summary from an earlier pass, so the flat file is not read again. columns, if given, are the
+    flat file columns to read (summary_columns and more) when it is read whole; the rows read are then kept in the
+    summary as 'settlement_df' for the caller. The reports are loaded concurrently (see load_reports)'''
+    loaders = {'fba-archive': partial(read_fba_archive, fba_inventory_report)}
+    streamed = bool(chunksize) or summary is not None
+    if streamed:
+        if summary is None:
+            loaders['settlement'] = partial(read_settlement_summary, flat_file, chunksize)
+        if invoiced_file is not None:
+            loaders['invoiced'] = partial(read_settlement_summary, invoiced_file, chunksize or 1000000, skip_first_row=True)
+    else:
+        loaders['settlement'] = partial(read_settlement, flat_file, columns)
+        if invoiced_file is not None:
+            loaders['invoiced'] = partial(read_invoiced, invoiced_file, columns)
+    if storage_report is not None:
+        loaders['storage'] = partial(read_monthly_storage, storage_report)
+    if lts_report is not None:
+        loaders['lts'] = partial(read_lts, lts_report)
+    if advertising_report is not None:
+        if threads == 1:
+            loaders['advertising'] = partial(read_advertising, advertising_report)
+        else:
+            loaders['advertising'] = partial(read_in_process, read_advertising, advertising_report)
+    if helium10 is not None:
+        loaders['cost'] = partial(read_cost, helium10)
+    reports = load_reports(loaders, threads)
+    if streamed:
+        summary = reports.get('settlement', summary)
+        if invoiced_file is not None:
+            summary = combine_summaries([summary, reports['invoiced']])
+    else:
+        settlement_df = reports['settlement']
+        if invoiced_file is not None:
+            settlement_df = pd.concat([settlement_df, reports['invoiced']])
+        summary = summarize_settlement(settlement_df)
+        if columns is not None:
+            summary['settlement_df'] = settlement_df
+    if summary_storage_charged(summary) and storage_report is None:
+        print(flat_file + ': monthly storage was charged but no storage report was given', file=sys.stderr)
+    if summary_lts_charged(summary) and lts_report is None:
+        print(flat_file + ': long-term storage was charged but no LTS report was given', file=sys.stderr)
+    tabs = analyze_summary(summary, reports['fba-archive'], reports.get('storage'), reports.get('lts'), reports.get('advertising'), reports.get('cost'))
+    if sku_families is not None:
+        tabs = add_sku_families(tabs, load_sku_families(sku_families))
+    return summary, tabs
+
+def run_gui():
+    '''Asks for each report through file dialogs, then exports the report'''
+    #imported here so the analysis can run headless on machines without a display
+    import PySimpleGUI as sg
+    flatfile_form = sg.FlexForm('Settlement Analyzer') 
     layout = [
-            [sg.Text('Please select Invoiced Flat File (v2)')],
-            [sg.Text('Invoiced Flat File (V2): ', size=(50, 1)), sg.FileBrowse()],
-            [sg.Submit(), sg.Cancel()]
-            ]
-    button, invoice_filename = get_invoiced_form.Layout(layout).Read() 
-    invoiced_file = invoice_filename['Browse']
-    get_invoiced_form.close()
-    invoice_df = pd.read_table(invoiced_file, sep='\t', dtype=dtypes)
-    #remove the total amount/date row from the invoiced one
-    invoice_df =invoice_df.drop(index=0)
-    combined_df = pd.concat([settlement_df, invoice_df])
-    ''' remove when finished debuging combining invoiced and main settlements
-    #debug
-    print(combined_df)
-    writer = pd.ExcelWriter("debug_output_1" + ".xlsx", engine='xlsxwriter')
-    combined_df.to_excel(writer, sheet_name='Test')
-    writer.close()
-else:
-    #otherdebug
-    print(settlement_df)
-    writer = pd.ExcelWriter("debug_output" + ".xlsx", engine='xlsxwriter')
-    settlement_df.to_excel(writer, sheet_name="test1")
-    writer.close()'''
-statement_timeframe =  get_statement_period(settlement_df)
-timeframe_layout = [  [sg.Text('Statement period start time: ' + statement_timeframe[0])],
-            [sg.Text('Statement period end time: ' + statement_timeframe[1])],
-            [sg.OK()]]
-window = sg.Window('Window Title', timeframe_layout)
-event = window.read()
-window.close()
-if adding_invoiced:
-    settlement_df = combined_df
-fba_archive_form = sg.FlexForm('Settlement Analyzer')
-layout = [
-          [sg.Text('Please select FBA Archive report')],
-          [sg.Text('FBA Inventory Archive:', size=(50, 1)), sg.FileBrowse()],
-          [sg.Submit(), sg.Cancel()]
-         ]
-button, fbaarchivename =  fba_archive_form.Layout(layout).Read() 
-fba_inventory_report = fbaarchivename['Browse']
-fba_archive_form.close()
-manage_fba_inventory_df = pd.read_csv(fba_inventory_report, encoding = 'latin1')
-asins_and_skus_df = get_asin_and_title(manage_fba_inventory_df)
-if monthly_storage_charged(settlement_df):
-    storage_form = sg.FlexForm('Settlement Analyzer') 
-    storage_form_layout = [
-            [sg.Text('Please select appropiate storage report (report corresponding to month before statement end date)')],
-            [sg.Text('Statement Start Date: ' + statement_timeframe[0])],
-            [sg.Text('Monthly Storage Report:', size=(50, 1)), sg.FileBrowse()],
-            [sg.Submit(), sg.Cancel()]
-            ]
-    button, storagefilename = storage_form.Layout(storage_form_layout).Read() 
-    storage_report= storagefilename['Browse']
-    storage_form.close()
-    monthly_storage_df =  pd.read_csv(storage_report, encoding='latin1')
-    storage_sku_df = get_storage_with_sku(monthly_storage_df, manage_fba_inventory_df)
-if lts_charged(settlement_df):
-    storage_form = sg.FlexForm('Settlement Analyzer') 
-    storage_form_layout = [
-            [sg.Text('Long-Term Storage Detected. Please select appropiate LTS report (15th of current month, Inventory Surcharge Rep)')],
-            [sg.Text('Statement Start Date: ' + statement_timeframe[0])],
-            [sg.Text('Long-Term Storage Report:', size=(50, 1)), sg.FileBrowse()],
-            [sg.Submit(), sg.Cancel()]
-            ]
-    button, storagefilename = storage_form.Layout(storage_form_layout).Read() 
-    lts_report= storagefilename['Browse']
-    storage_form.close()
-    lts_df =  pd.read_csv(lts_report, encoding='latin1')
-    lts_sku_df = get_lts_with_sku(lts_df)
-option_form = sg.FlexForm('Settlement Analyzer') 
-layout = [
-          [sg.Text('Select the following optional parameters')],
-          [sg.Radio("Use cost file to calculate profit/roi", "Radio1", default=False)], 
-          [sg.Radio("Add Advertising Report", "Radio2", default=False)],
-          [sg.Submit(), sg.Cancel()]
-         ]
-button, options =  option_form.Layout(layout).Read() 
-option_form.close()
-adding_cost = options[0] 
-adding_advertising = options[1]
-if adding_advertising:
-    advertising_form = sg.FlexForm('Settlement Analyzer')
+              [sg.Text('Please select Flat File (v2)')],
+              [sg.Text('Statement File: ', size=(50, 1)), sg.FileBrowse()],
+              [sg.Submit(), sg.Cancel()]
+             ]
+    button, filename = flatfile_form.Layout(layout).Read() 
+    flat_file = filename['Browse']
+    flatfile_form.close()
+    settlement_df = read_settlement(flat_file)
+    #invoiced_form = sg.FlexForm('Settlement Analyzer') 
+    #layout = [
+    #          [sg.Text('Would you like to add invoiced orders too?')],
+    #          [sg.Radio("Yes", "Radio1", default=False)], 
+    #          [sg.Radio("No", "Radio2", default=False)],
+    #          [sg.Submit(), sg.Cancel()]
+    #         ]
+    #button, add_invoiced =  invoiced_form.Layout(layout).Read() 
+    #invoiced_form.close()
+    #adding_invoiced = add_invoiced[0] 
+    adding_invoiced = False
+    if adding_invoiced:
+        get_invoiced_form = sg.FlexForm('Settlement Analyzer') 
+        layout = [
+                [sg.Text('Please select Invoiced Flat File (v2)')],
+                [sg.Text('Invoiced Flat File (V2): ', size=(50, 1)), sg.FileBrowse()],
+                [sg.Submit(), sg.Cancel()]
+                ]
+        button, invoice_filename = get_invoiced_form.Layout(layout).Read() 
+        invoiced_file = invoice_filename['Browse']
+        get_invoiced_form.close()
+        invoice_df = read_invoiced(invoiced_file)
+        settlement_df = pd.concat([settlement_df, invoice_df])
+    #one pass over the settlement for the totals, charge flags and statement period used below
+    summary = summarize_settlement(settlement_df)
+    statement_timeframe = summary['statement_period']
+    timeframe_layout = [  [sg.Text('Statement period start time: ' + statement_timeframe[0])],
+                [sg.Text('Statement period end time: ' + statement_timeframe[1])],
+                [sg.OK()]]
+    window = sg.Window('Window Title', timeframe_layout)
+    event = window.read()
+    window.close()
+    fba_archive_form = sg.FlexForm('Settlement Analyzer')
     layout = [
-            [sg.Text('Please select appropiate Advertising Report (sponsored product)')],
-            [sg.Text('Statement period start time: ' + statement_timeframe[0])],
-            [sg.Text('Statement period end time: ' + statement_timeframe[1])],
-            [sg.Text('Amazon Advertising Report', size=(50, 1)), sg.FileBrowse()],
-            [sg.Submit(), sg.Cancel()]
-         ]
-    button, adreportname =  advertising_form.Layout(layout).Read() 
-    advertising_report = adreportname['Browse']
-    advertising_form.close()
-    advertising_df = pd.read_excel(advertising_report)
-    advertising_spend = get_advertising_spend(advertising_df)
-if adding_cost:
-    cost_form = sg.FlexForm('Settlement Analyzer')
+              [sg.Text('Please select FBA Archive report')],
+              [sg.Text('FBA Inventory Archive:', size=(50, 1)), sg.FileBrowse()],
+              [sg.Submit(), sg.Cancel()]
+             ]
+    button, fbaarchivename =  fba_archive_form.Layout(layout).Read() 
+    fba_inventory_report = fbaarchivename['Browse']
+    fba_archive_form.close()
+    manage_fba_inventory_df = read_fba_archive(fba_inventory_report)
+    monthly_storage_df = None
+    lts_df = None
+    advertising_df = None
+    helium10_df = None
+    if summary_storage_charged(summary):
+        storage_form = sg.FlexForm('Settlement Analyzer') 
+        storage_form_layout = [
+                [sg.Text('Please select appropiate storage report (report corresponding to month before statement end date)')],
+                [sg.Text('Statement Start Date: ' + statement_timeframe[0])],
+                [sg.Text('Monthly Storage Report:', size=(50, 1)), sg.FileBrowse()],
+                [sg.Submit(), sg.Cancel()]
+                ]
+        button, storagefilename = storage_form.Layout(storage_form_layout).Read() 
+        storage_report= storagefilename['Browse']
+        storage_form.close()
+        monthly_storage_df = read_monthly_storage(storage_report)
+    if summary_lts_charged(summary):
+        storage_form = sg.FlexForm('Settlement Analyzer') 
+        storage_form_layout = [
+                [sg.Text('Long-Term Storage Detected. Please select appropiate LTS report (15th of current month, Inventory Surcharge Rep)')],
+                [sg.Text('Statement Start Date: ' + statement_timeframe[0])],
+                [sg.Text('Long-Term Storage Report:', size=(50, 1)), sg.FileBrowse()],
+                [sg.Submit(), sg.Cancel()]
+                ]
+        button, storagefilename = storage_form.Layout(storage_form_layout).Read() 
+        lts_report= storagefilename['Browse']
+        storage_form.close()
+        lts_df = read_lts(lts_report)
+    option_form = sg.FlexForm('Settlement Analyzer') 
     layout = [
-            [sg.Text('Please select formatted cost.csv file')],
-            [sg.Text('Cost.csv file location:', size=(50, 1)), sg.FileBrowse()],
+              [sg.Text('Select the following optional parameters')],
+              [sg.Radio("Use cost file to calculate profit/roi", "Radio1", default=False)], 
+              [sg.Radio("Add Advertising Report", "Radio2", default=False)],
+              [sg.Submit(), sg.Cancel()]
+             ]
+    button, options =  option_form.Layout(layout).Read() 
+    option_form.close()
+    adding_cost = options[0] 
+    adding_advertising = options[1]
+    if adding_advertising:
+        advertising_form = sg.FlexForm('Settlement Analyzer')
+        layout = [
+                [sg.Text('Please select appropiate Advertising Report (sponsored product)')],
+                [sg.Text('Statement period start time: ' + statement_timeframe[0])],
+                [sg.Text('Statement period end time: ' + statement_timeframe[1])],
+                [sg.Text('Amazon Advertising Report', size=(50, 1)), sg.FileBrowse()],
+                [sg.Submit(), sg.Cancel()]
+             ]
+        button, adreportname =  advertising_form.Layout(layout).Read() 
+        advertising_report = adreportname['Browse']
+        advertising_form.close()
+        advertising_df = read_advertising(advertising_report)
+    if adding_cost:
+        cost_form = sg.FlexForm('Settlement Analyzer')
+        layout = [
+                [sg.Text('Please select formatted cost.csv file')],
+                [sg.Text('Cost.csv file location:', size=(50, 1)), sg.FileBrowse()],
+                [sg.Submit(), sg.Cancel()]
+                ]
+        button, cost_form_input =  cost_form.Layout(layout).Read() 
+        helium10= cost_form_input['Browse']
+        cost_form.close()
+        helium10_df = read_cost(helium10)
+    tabs = analyze_summary(summary, manage_fba_inventory_df, monthly_storage_df, lts_df, advertising_df, helium10_df)
+    #family tabs when a sku_families.json sits next to the analyzer
+    if os.path.exists(default_sku_families):
+        tabs = add_sku_families(tabs, load_sku_families(default_sku_families))
+    output_form= sg.FlexForm('Settlement Analyzer')
+    layout = [
+            [sg.Text('Please type a file prefix')],
+            [sg.Input()],
             [sg.Submit(), sg.Cancel()]
             ]
-    button, cost_form_input =  cost_form.Layout(layout).Read() 
-    helium10= cost_form_input['Browse']
-    cost_form.close()
-    helium10_df = pd.read_csv(helium10)
-    product_cost_df = get_cost(helium10_df)
-finalized_report = main_table(settlement_df)
-overview_tab = get_overview(settlement_df)
-niro_tab = filter_niro_skus(finalized_report)
-hd_tab = filter_hd_skus(finalized_report)
-other_tab = filter_other_skus(finalized_report)
-#refund_tab = get_refunds(settlement_df, finalized_report)
-output_form= sg.FlexForm('Settlement Analyzer')
-layout = [
-        [sg.Text('Please type a file prefix')],
-        [sg.Input()],
-        [sg.Submit(), sg.Cancel()]
-        ]
-button, output_name =  output_form.Layout(layout).Read() 
-output_form.close()
-export_report(output_name[0])
\ No newline at end of file
+    button, output_name =  output_form.Layout(layout).Read() 
+    output_form.close()
+    export_report(output_name[0], statement_timeframe, tabs)
+    if profiling.enabled:
+        profiling.write_trace(output_name[0] + '_profile.json', top=10)
+
+if __name__ == '__main__':
+    run_gui()
@@ -0,0 +1,197 @@
+'''Multi-account, multi-marketplace processing.
+
+Settlement rows are split into partitions by (account, marketplace, currency), and each partition goes through the
+same summary -> main table -> overview path as a single settlement. Flat files are read and split in a process
+pool, then each account's partitions are analyzed in the pool with that account's reports. The workbook has a
+Sales and Overview tab per partition, plus totals across partitions converted into one reporting currency.
+
+Accounts are described in a JSON file:
+    {"report_currency": "USD", "rates": {"CAD": 0.74, "GBP": 1.27},
+     "accounts": [{"account": "Main", "flat_files": ["settlements/main/"], "fba_archive": "main_archive.csv",
+                   "storage": "storage.csv", "lts": null, "advertising": null, "cost": "cost.csv"}]}
+A flat_files entry that is a folder stands for every flat file in it. Rates convert one unit of a currency into
+the report currency; pass any rate(currency) function to partition_totals for other sources.
+'''
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from main import (add_ratio_columns, analyze_summary, as_category, combine_summaries, export_report, find_flat_files,
+    get_first_value, get_settlement_id, get_statement_period, load_reports, parse_settlement_date, read_advertising, read_cost,
+    read_fba_archive, read_lts, read_monthly_storage, read_settlement, rename_columns, restore_column_names, summarize_settlement,
+    summary_columns, summed_columns, unit_columns)
+from report_writer import file_safe, write_report
+
+partition_columns = summary_columns + ['marketplace-name']
+
+#optional reports of an account -> reader
+account_readers = {'storage': read_monthly_storage, 'lts': read_lts, 'advertising': read_advertising, 'cost': read_cost}
+
+def load_accounts(path):
+    '''Reads the accounts file, expanding folders in flat_files into the flat files they hold'''
+    with open(path) as f:
+        config = json.load(f)
+    for account in config['accounts']:
+        flat_files = []
+        for entry in account['flat_files']:
+            flat_files += find_flat_files(entry) if os.path.isdir(entry) else [entry]
+        account['flat_files'] = flat_files
+    return config
+
+def partition_label(key):
+    '''Short name of a partition for sheet and file names: account, marketplace without "Amazon.", currency'''
+    account, marketplace, currency = key
+    marketplace = marketplace[len('Amazon.'):] if marketplace.startswith('Amazon.') else marketplace
+    return ' '.join([account, marketplace, currency])
+
+def fill_codes(column, default):
+    '''Returns the category codes and categories of a column, with missing values coded as default'''
+    column = as_category(column)
+    categories = column.cat.categories
+    if default not in categories:
+        categories = categories.append(pd.Index([default]))
+    codes = column.cat.codes.to_numpy().astype(np.int64)
+    codes[codes < 0] = categories.get_loc(default)
+    return codes, categories
+
+def split_settlement(settlement_df, account):
+    '''Returns {(account, marketplace, currency): summary} for the rows of one settlement. Rows without a marketplace
+    (storage, subscription, reserve) go to the settlement's busiest marketplace and rows without a currency take the
+    settlement's. Every partition keeps the settlement-id and statement period of the whole file'''
+    marketplaces = as_category(settlement_df['marketplace-name']).value_counts()
+    default_marketplace = marketplaces.idxmax() if marketplaces.sum() else 'Unknown'
+    marketplace_codes, marketplace_names = fill_codes(settlement_df['marketplace-name'], default_marketplace)
+    currency_codes, currencies = fill_codes(settlement_df['currency'], get_first_value(settlement_df, 'currency') or 'Unknown')
+    partition_codes = marketplace_codes * len(currencies) + currency_codes
+    settlement_id = get_settlement_id(settlement_df)
+    statement_period = get_statement_period(settlement_df)
+    partitions = {}
+    for code in np.unique(partition_codes):
+        key = (account, str(marketplace_names[code // len(currencies)]), str(currencies[code % len(currencies)]))
+        summary = summarize_settlement(settlement_df.loc[partition_codes == code])
+        summary.update({'settlement_id': settlement_id, 'statement_period': statement_period, 'currency': key[2]})
+        partitions[key] = summary
+    return partitions
+
+def split_flat_file(flat_file, account):
+    '''Reads a flat file with its marketplace column and splits it (see split_settlement)'''
+    return split_settlement(read_settlement(flat_file, partition_columns), account)
+
+def combine_partition(summaries):
+    '''Adds up the summaries of one partition across settlements. The period runs from the earliest start to the latest end'''
+    combined = combine_summaries(summaries)
+    periods = [summary['statement_period'] for summary in summaries if summary['statement_period']]
+    if periods:
+        combined['statement_period'] = [min((period[0] for period in periods), key=parse_settlement_date),
+            max((period[1] for period in periods), key=parse_settlement_date)]
+    return combined
+
+def advertising_by_partition(advertising_df, partitions):
+    '''Returns {key: advertising rows} giving each advertised SKU's spend to the one partition that sold the most
+    units of it, so an account's spend is counted once. SKUs no partition sold go to the partition with the most rows,
+    like the storage and LTS charges'''
+    keys = list(partitions)
+    units = pd.concat([partitions[key]['sku_metrics']['Units Sold'] for key in keys], axis=1, keys=range(len(keys))).fillna(0)
+    busiest = int(np.argmax([partitions[key]['rows'] for key in keys]))
+    owners = pd.Series(np.where(units.max(axis=1).to_numpy() > 0, units.to_numpy().argmax(axis=1), busiest), index=units.index.astype(str))
+    owner = advertising_df['Advertised SKU'].astype(str).map(owners).fillna(busiest).to_numpy()
+    return {key: advertising_df.loc[owner == position] for position, key in enumerate(keys)}
+
+def analyze_account(account, partitions):
+    '''Loads an account's reports once and analyzes each of its partitions. Returns {key: tabs}'''
+    loaders = {'fba-archive': lambda: read_fba_archive(account['fba_archive'])}
+    for name, reader in account_readers.items():
+        if account.get(name):
+            loaders[name] = lambda reader=reader, path=account[name]: reader(path)
+    reports = load_reports(loaders)
+    advertising = advertising_by_partition(reports['advertising'], partitions) if reports.get('advertising') is not None else {}
+    return {key: analyze_summary(summary, reports['fba-archive'], reports.get('storage'), reports.get('lts'), advertising.get(key), reports.get('cost'))
+        for key, summary in partitions.items()}
+
+def rate_table(rates, report_currency):
+    '''Returns a rate(currency) hook from a {currency: value of one unit in the report currency} table'''
+    def rate(currency):
+        if currency == report_currency:
+            return 1.0
+        if currency not in rates:
+            raise ValueError('No rate from ' + currency + ' to ' + report_currency + ' in the accounts file')
+        return float(rates[currency])
+    return rate
+
+def partition_totals(partition_tabs, rate):
+    '''Returns the Sales totals of every partition and the Overview lines summed across partitions, with amounts
+    converted by rate(currency). Units are not converted; ratio columns are recomputed from the converted sums'''
+    rows = {}
+    overviews = []
+    for key, tabs in partition_tabs.items():
+        conversion = rate(key[2])
+        main_df = restore_column_names(tabs['Sales'])
+        totals = main_df[[column for column in summed_columns if column in main_df]].sum()
+        money = [column for column in totals.index if column not in unit_columns and column != 'Total Units']
+        totals[money] = totals[money] * conversion
+        rows[partition_label(key)] = pd.concat([pd.Series({'Account': key[0], 'Marketplace': key[1], 'Currency': key[2], 'Rate': conversion}), totals])
+        overviews.append(tabs['Overview'] * conversion)
+    numeric = [column for column in summed_columns if any(column in row for row in rows.values())]
+    totals = pd.DataFrame(rows).T[['Account', 'Marketplace', 'Currency', 'Rate'] + numeric]
+    #a column only some partitions have (advertising, cost) is zero for the rest
+    totals[numeric] = totals[numeric].astype(np.float64).fillna(0)
+    totals.loc['Total', numeric] = totals[numeric].sum()
+    totals = rename_columns(add_ratio_columns(totals))
+    totals.index.name = 'partition'
+    overview = pd.concat(overviews).groupby(level=0, sort=False).sum()
+    return totals, overview
+
+def export_partition_report(output_prefix, statement_period, tabs, formats):
+    '''Writes a report named after its statement period, or after the prefix alone when its rows had no dates'''
+    if statement_period is None:
+        return write_report(output_prefix, tabs, formats)
+    return export_report(output_prefix, statement_period, tabs, formats)
+
+def run_accounts(config, output_prefix, workers=None, formats=('xlsx',), partition_files=False):
+    '''Splits every account's flat files into partitions, analyzes them and writes one workbook with a Sales and
+    Overview tab per partition and the converted totals. With partition_files each partition also gets its own
+    report. Returns the files written'''
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for account in config['accounts']:
+            for flat_file in account['flat_files']:
+                futures[executor.submit(split_flat_file, flat_file, account['account'])] = flat_file
+        for future in as_completed(futures):
+            try:
+                partitions = future.result()
+            except Exception as error:
+                print(futures[future] + ' failed: ' + repr(error), file=sys.stderr)
+                continue
+            for key, summary in partitions.items():
+                summaries.setdefault(key, []).append(summary)
+        partitions = {key: combine_partition(summaries[key]) for key in sorted(summaries)}
+        futures = []
+        for account in config['accounts']:
+            account_partitions = {key: summary for key, summary in partitions.items() if key[0] == account['account']}
+            if account_partitions:
+                futures.append(executor.submit(analyze_account, account, account_partitions))
+        partition_tabs = {}
+        for future in futures:
+            partition_tabs.update(future.result())
+    partition_tabs = {key: partition_tabs[key] for key in sorted(partition_tabs)}
+    rate = rate_table(config.get('rates', {}), config.get('report_currency', 'USD'))
+    totals, overview = partition_totals(partition_tabs, rate)
+    tabs = {'Totals': totals, 'Overview Totals': overview}
+    for key, partition in partition_tabs.items():
+        tabs[partition_label(key) + ' Sales'] = partition['Sales']
+        tabs[partition_label(key) + ' Overview'] = partition['Overview']
+    periods = [summary['statement_period'] for summary in partitions.values() if summary['statement_period']]
+    period = None
+    if periods:
+        period = [min((period[0] for period in periods), key=parse_settlement_date), max((period[1] for period in periods), key=parse_settlement_date)]
+    reports = export_partition_report(output_prefix, period, tabs, formats)
+    if partition_files:
+        for key, partition in partition_tabs.items():
+            prefix = output_prefix + '_' + file_safe(partition_label(key))
+            reports += export_partition_report(prefix, partitions[key]['statement_period'], {'Sales': partition['Sales'], 'Overview': partition['Overview']}, formats)
+    return reports
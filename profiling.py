@@ -0,0 +1,128 @@
+'''Per-stage timing for slow runs.
+
+Turned on with FBA_PROFILE=1 (or cli.py --profile). Every stage records its wall time, the process's peak RSS and
+the rows it was given and returned, and the run is written as a Chrome trace (chrome://tracing, Perfetto and
+speedscope draw it as a flame graph). When profiling is off, profiled functions only check one flag.
+'''
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    #no peak RSS on Windows
+    resource = None
+
+enabled = os.environ.get('FBA_PROFILE', '') not in ('', '0')
+events = []
+local = threading.local()
+start_time = time.perf_counter()
+
+def enable():
+    '''Turns profiling on here and in worker processes started afterwards'''
+    global enabled
+    enabled = True
+    os.environ['FBA_PROFILE'] = '1'
+
+def reset():
+    '''Forgets the recorded stages, e.g. before the next settlement of a batch'''
+    global start_time
+    del events[:]
+    start_time = time.perf_counter()
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def row_count(value):
+    '''Rows of a dataframe/series result, None for anything else'''
+    if hasattr(value, 'shape') and hasattr(value, 'index'):
+        return int(value.shape[0])
+    return None
+
+class Stage:
+    '''Context manager timing one stage. Nested stages take their time out of their parent's self time'''
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+        stack.append(self)
+        self.child_seconds = 0.0
+        self.peak_before = peak_rss_mb()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.started
+        local.stack.pop()
+        if local.stack:
+            local.stack[-1].child_seconds += seconds
+        peak_after = peak_rss_mb()
+        events.append({
+            'name': self.name,
+            'ph': 'X',
+            'ts': round((self.started - start_time) * 1e6, 1),
+            'dur': round(seconds * 1e6, 1),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {
+                'seconds': seconds,
+                'self_seconds': seconds - self.child_seconds,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'peak_rss_mb': peak_after,
+                'peak_rss_growth_mb': peak_after - self.peak_before if peak_after is not None else None,
+            },
+        })
+        return False
+
+def stage(name, rows_in=None):
+    '''with stage('name'): ... records the block when profiling is on'''
+    if not enabled:
+        return nullcontext()
+    return Stage(name, rows_in)
+
+def profiled(func):
+    '''Records every call of a function as a stage, with the rows of its first argument and of its result'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        with Stage(func.__name__, row_count(args[0]) if args else None) as current:
+            result = func(*args, **kwargs)
+            current.rows_out = row_count(result)
+        return result
+    return wrapper
+
+def slowest(top):
+    '''Returns the recorded stages with the most self time (time not spent in nested stages)'''
+    return sorted(events, key=lambda event: event['args']['self_seconds'], reverse=True)[:top]
+
+def write_trace(path, top=None):
+    '''Writes the recorded stages as a Chrome trace JSON file and, with top, prints the slowest stages to stderr.
+    Returns the path written'''
+    trace = {'traceEvents': sorted(events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms'}
+    with open(path, 'w') as f:
+        json.dump(trace, f, indent=1)
+    if top:
+        print('slowest stages (self time) in ' + path + ':', file=sys.stderr)
+        for event in slowest(top):
+            args = event['args']
+            rows = args['rows_out'] if args['rows_out'] is not None else args['rows_in']
+            rows = '' if rows is None else ', ' + str(rows) + ' rows'
+            print('  {:<40} {:9.3f}s{}'.format(event['name'], args['self_seconds'], rows), file=sys.stderr)
+    return path
@@ -0,0 +1,133 @@
+'''On-disk cache of parsed reports.
+
+Each parsed report is stored as a Feather (Arrow) file keyed by the content hash of the source file and the
+schema it was parsed with, so a repeat run memory-maps the columnar file instead of re-parsing the text.
+The cache is off unless FBA_CACHE_DIR is set (cli.py sets it from --cache). FBA_CACHE_MAX_MB caps its size;
+the least recently used entries are evicted first.
+'''
+import hashlib
+import os
+import pickle
+import tempfile
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+#bump when a reader changes how it parses a report
+cache_version = 1
+default_max_mb = 2048
+
+def cache_directory():
+    '''Returns the cache directory, None when caching is off'''
+    return os.environ.get('FBA_CACHE_DIR') or None
+
+def cache_max_bytes():
+    return int(os.environ.get('FBA_CACHE_MAX_MB', default_max_mb)) * 1024 * 1024
+
+def file_digest(path, block_size=1024 * 1024):
+    '''Returns the sha256 of a file, read in fixed size blocks'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def schema_digest(schema):
+    '''Short hash of the dtype map (or any other reader options) a report was parsed with'''
+    text = repr(sorted(schema.items())) if isinstance(schema, dict) else repr(schema)
+    return hashlib.sha256((str(cache_version) + text).encode()).hexdigest()[:12]
+
+def cache_key(path, kind, schema=None):
+    return kind + '-' + file_digest(path) + '-' + schema_digest(schema)
+
+def find_entry(directory, key):
+    '''Returns the cached file for a key, None if there is none'''
+    for extension in ('.feather', '.pkl'):
+        entry = os.path.join(directory, key + extension)
+        if os.path.exists(entry):
+            return entry
+    return None
+
+def load_entry(entry):
+    if entry.endswith('.feather'):
+        return feather.read_table(entry, memory_map=True).to_pandas()
+    with open(entry, 'rb') as f:
+        return pickle.load(f)
+
+def store_entry(directory, key, report_df):
+    '''Writes a parsed report atomically. Feather needs pyarrow and a default index, anything else is pickled'''
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    try:
+        if feather is not None and isinstance(report_df.index, pd.RangeIndex) and report_df.index.start == 0 and report_df.index.step == 1:
+            try:
+                feather.write_feather(report_df, temporary)
+                extension = '.feather'
+            except Exception:
+                #columns pyarrow can't convert (mixed object types) fall back to pickle
+                extension = None
+        else:
+            extension = None
+        if extension is None:
+            with open(temporary, 'wb') as f:
+                pickle.dump(report_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            extension = '.pkl'
+        os.replace(temporary, os.path.join(directory, key + extension))
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def evict(directory, max_bytes):
+    '''Deletes the least recently used entries until the cache fits in max_bytes'''
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.feather') or name.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                #evicted by another thread or process in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
+
+def cached_read(path, kind, reader, schema=None):
+    '''Returns reader(path), served from the cache when this file was already parsed with the same schema'''
+    directory = cache_directory()
+    if directory is None:
+        return reader(path)
+    key = cache_key(path, kind, schema)
+    entry = find_entry(directory, key)
+    if entry is not None:
+        try:
+            report_df = load_entry(entry)
+            #touch so eviction sees it as recently used
+            os.utime(entry)
+            return report_df
+        except Exception:
+            os.remove(entry)
+    report_df = reader(path)
+    store_entry(directory, key, report_df)
+    evict(directory, cache_max_bytes())
+    return report_df
+
+def clear_cache():
+    '''Deletes every cached report'''
+    directory = cache_directory()
+    if directory is None or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.feather') or name.endswith('.pkl'):
+            os.remove(os.path.join(directory, name))
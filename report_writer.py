@@ -0,0 +1,135 @@
+'''Writes report tabs (a dict of sheet name -> dataframe) to Excel, CSV or Parquet.
+
+Excel is written with xlsxwriter's constant_memory mode, row by row in one pass per sheet, with a number
+format set once per column instead of per cell. CSV and Parquet skip Excel entirely for downstream systems.
+'''
+import re
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from profiling import profiled, stage
+
+output_formats = ['xlsx', 'csv', 'parquet']
+
+#number formats by kind of column
+number_formats = {
+    'money': '#,##0.00;-#,##0.00',
+    'percent': '0.00%',
+    'units': '#,##0',
+}
+
+#report columns shown as whole units
+unit_column_names = {'Rows', 'Settlements', 'Units Sold', 'N/S Units', 'MF Units', 'Total', 'Non-Sale Units', 'Merchant Fulfilled Units', 'Total Units'}
+
+def column_kind(name, column):
+    '''Returns money, percent, units or None (text) for a report column'''
+    if not pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+        return None
+    name = str(name)
+    if '%' in name or name.startswith('ROI') or 'Rate' in name or 'Percent' in name:
+        return 'percent'
+    if name in unit_column_names or 'Units' in name:
+        return 'units'
+    return 'money'
+
+def column_values(column):
+    '''Returns a column as a numpy array xlsxwriter can write. Numbers without missing values are handed over
+    as they are; only dates, categories, text, booleans and columns with missing values become python objects, None for missing'''
+    column = pd.Series(column)
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column) and not pd.api.types.is_extension_array_dtype(column):
+        values = column.to_numpy()
+        if values.dtype.kind != 'f' or not np.isnan(values).any():
+            return values
+    column = column.astype(object)
+    return column.where(column.notna(), None).to_numpy()
+
+def sheet_rows(tab):
+    '''Yields each row (index first), None for missing'''
+    return zip(column_values(tab.index), *(column_values(tab.iloc[:, position]) for position in range(tab.shape[1])))
+
+def write_sheet(workbook, sheet_name, tab, formats, header_format):
+    worksheet = workbook.add_worksheet(sheet_name)
+    names = [tab.index.name or ''] + [str(column) for column in tab.columns]
+    kinds = [None] + [column_kind(column, tab[column]) for column in tab.columns]
+    for position, (name, kind) in enumerate(zip(names, kinds)):
+        width = max(10, min(len(name) + 2, 40))
+        if position == 0 or kind is None:
+            width = 20 if position == 0 else max(width, 14)
+        worksheet.set_column(position, position, width, formats.get(kind))
+    worksheet.write_row(0, 0, names, header_format)
+    worksheet.freeze_panes(1, 1)
+    for row_number, row in enumerate(sheet_rows(tab), start=1):
+        worksheet.write_row(row_number, 0, row)
+
+def unique_sheet_names(names):
+    '''Excel sheet names are at most 31 characters, unique and without []:*?/\\'''
+    used = set()
+    unique = []
+    for name in names:
+        base = re.sub(r'[\[\]:*?/\\]', '-', str(name))[:31]
+        candidate = base
+        number = 2
+        while candidate.lower() in used:
+            suffix = ' (' + str(number) + ')'
+            candidate = base[:31 - len(suffix)] + suffix
+            number += 1
+        used.add(candidate.lower())
+        unique.append(candidate)
+    return unique
+
+@profiled
+def write_excel(path, tabs):
+    '''Writes every tab to one workbook in constant_memory mode'''
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'nan_inf_to_errors': True, 'default_date_format': 'yyyy-mm-dd'})
+    formats = {kind: workbook.add_format({'num_format': number_format}) for kind, number_format in number_formats.items()}
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    for sheet_name, tab in zip(unique_sheet_names(tabs), tabs.values()):
+        with stage('write sheet ' + sheet_name, len(tab)):
+            write_sheet(workbook, sheet_name, tab, formats, header_format)
+    with stage('close workbook'):
+        workbook.close()
+    return path
+
+def file_safe(name):
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', str(name)).strip('_')
+
+@profiled
+def write_csv(prefix, tabs):
+    '''Writes each tab to prefix_<tab>.csv'''
+    paths = []
+    for sheet_name, tab in tabs.items():
+        path = prefix + '_' + file_safe(sheet_name) + '.csv'
+        tab.to_csv(path)
+        paths.append(path)
+    return paths
+
+@profiled
+def write_parquet(prefix, tabs):
+    '''Writes each tab to prefix_<tab>.parquet (needs pyarrow or fastparquet)'''
+    paths = []
+    for sheet_name, tab in tabs.items():
+        path = prefix + '_' + file_safe(sheet_name) + '.parquet'
+        tab = tab.copy()
+        tab.columns = [str(column) for column in tab.columns]
+        #text columns of the main table hold 0 where a SKU is missing from the FBA archive
+        for column in tab.columns[tab.dtypes == object]:
+            tab[column] = tab[column].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+        tab.replace([np.inf, -np.inf], np.nan).to_parquet(path)
+        paths.append(path)
+    return paths
+
+def write_report(prefix, tabs, formats=('xlsx',)):
+    '''Writes the tabs in every format asked for. Returns the files written'''
+    paths = []
+    for output_format in formats:
+        if output_format == 'xlsx':
+            paths.append(write_excel(prefix + '.xlsx', tabs))
+        elif output_format == 'csv':
+            paths += write_csv(prefix, tabs)
+        elif output_format == 'parquet':
+            paths += write_parquet(prefix, tabs)
+        else:
+            raise ValueError('Unknown output format ' + repr(output_format) + ', expected one of ' + ', '.join(output_formats))
+    return paths
@@ -0,0 +1,167 @@
+'''Month, quarter and year rollups over many settlements.
+
+Each analyzed settlement's main table (with its full column names) and overview are saved once under its
+settlement-id. A period rollup keeps the summed columns of the settlements that end in that period; saving a
+settlement adds its table to those sums (after taking out its earlier copy when the settlement-id was saved
+before), so it only costs that settlement whatever the size of the period. The ratio columns are recomputed from
+the summed numerators and denominators when a period is read. Each saved settlement is also added to the store's fee history
+(see fees.py).
+'''
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from fees import record_fees
+from main import add_ratio_columns, parse_settlement_date, rename_columns, restore_column_names, summed_columns, unit_columns
+from report_writer import write_report
+
+#columns taken from the latest settlement that has the SKU
+latest_columns = ['asin', 'product-name', 'Product Cost', 'Packing Cost']
+
+period_frequencies = {'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+def index_path(store):
+    return os.path.join(store, 'index.json')
+
+def load_index(store):
+    '''Returns {settlement-id: {'start', 'end', 'file'}} for every stored settlement'''
+    if not os.path.exists(index_path(store)):
+        return {}
+    with open(index_path(store)) as f:
+        return json.load(f)
+
+def write_index(store, index):
+    temporary = index_path(store) + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(temporary, index_path(store))
+
+def period_label(date, period):
+    '''Returns the month/quarter/year label (2023-03, 2023Q1, 2023) of a settlement date'''
+    return str(parse_settlement_date(date).tz_localize(None).to_period(period_frequencies[period]))
+
+def save_settlement(store, settlement_id, statement_period, main_df, overview_df):
+    '''Stores one settlement's main table (as returned by main_table) and overview and records its fees, then adds it
+    to the periods it ends in. A settlement saved again is first taken out of the periods of its earlier copy'''
+    os.makedirs(os.path.join(store, 'settlements'), exist_ok=True)
+    index = load_index(store)
+    if str(settlement_id) in index:
+        previous = load_settlement(store, settlement_id, index)
+        for period in period_frequencies:
+            update_period(store, period, period_label(index[str(settlement_id)]['end'], period), settlement_id, index[str(settlement_id)]['end'], previous, -1)
+    aggregate = {'main': restore_column_names(main_df), 'overview': overview_df}
+    filename = os.path.join('settlements', str(settlement_id) + '.pkl')
+    with open(os.path.join(store, filename), 'wb') as f:
+        pickle.dump(aggregate, f, protocol=pickle.HIGHEST_PROTOCOL)
+    index[str(settlement_id)] = {'start': statement_period[0], 'end': statement_period[1], 'file': filename}
+    write_index(store, index)
+    record_fees(store, settlement_id, statement_period, main_df)
+    for period in period_frequencies:
+        update_period(store, period, period_label(statement_period[1], period), settlement_id, statement_period[1], aggregate, 1)
+
+def load_settlement(store, settlement_id, index=None):
+    index = index if index is not None else load_index(store)
+    with open(os.path.join(store, index[str(settlement_id)]['file']), 'rb') as f:
+        return pickle.load(f)
+
+def add_aligned(left, right):
+    '''left + right over the union of their rows and columns (in order of appearance), missing cells counting as 0'''
+    rows = left.index.union(right.index, sort=False).rename(right.index.name)
+    if isinstance(left, pd.Series):
+        return left.reindex(rows, fill_value=0) + right.reindex(rows, fill_value=0)
+    columns = left.columns.union(right.columns, sort=False)
+    return left.reindex(index=rows, columns=columns, fill_value=0) + right.reindex(index=rows, columns=columns, fill_value=0)
+
+def empty_period():
+    '''A period rollup with no settlements: the summed columns and settlement count of every SKU, the latest_columns
+    of every SKU with the end date they were taken from, the summed overview with a count per line, the main table
+    column order and the {settlement-id: end} of its settlements'''
+    return {'sums': pd.DataFrame(columns=['settlements'], dtype=np.float64), 'latest': pd.DataFrame(columns=['end']),
+        'overview': pd.DataFrame(columns=['amount'], dtype=np.float64), 'overview_counts': pd.Series(dtype=np.int64),
+        'columns': [], 'settlements': {}}
+
+def add_settlement(rollup, settlement_id, end, aggregate, sign=1):
+    '''Adds (sign 1) or takes out (sign -1) one stored settlement aggregate to a period rollup. SKUs and overview
+    lines no settlement has any more are dropped. Taking out leaves the latest_columns alone'''
+    main_df = aggregate['main']
+    sums = main_df[[column for column in summed_columns if column in main_df]].astype(np.float64).groupby(level=0).sum()
+    sums['settlements'] = 1
+    sums = add_aligned(rollup['sums'], sums * sign)
+    rollup['sums'] = sums.loc[sums['settlements'] > 0]
+    overview = aggregate['overview'].groupby(level=0, sort=False).sum()
+    counts = add_aligned(rollup['overview_counts'], pd.Series(sign, index=overview.index))
+    rollup['overview'] = add_aligned(rollup['overview'], overview * sign).loc[counts > 0]
+    rollup['overview_counts'] = counts.loc[counts > 0]
+    if sign < 0:
+        rollup['settlements'].pop(str(settlement_id), None)
+        return rollup
+    rollup['settlements'][str(settlement_id)] = end
+    rollup['columns'] += [column for column in main_df.columns if column not in rollup['columns']]
+    latest = main_df[[column for column in latest_columns if column in main_df]].copy()
+    latest['end'] = parse_settlement_date(end)
+    current = rollup['latest']
+    overlap = current.index.intersection(latest.index)
+    #a SKU keeps the values of a later settlement already in the period
+    newer = overlap[(current.loc[overlap, 'end'] > parse_settlement_date(end)).to_numpy()]
+    rollup['latest'] = pd.concat([current.drop(overlap.difference(newer)), latest.drop(newer)])
+    return rollup
+
+def period_path(store, period, label):
+    return os.path.join(store, 'periods', period + '-' + label + '.pkl')
+
+def load_period(store, period, label):
+    '''Returns a stored period rollup, empty_period when it has none'''
+    if not os.path.exists(period_path(store, period, label)):
+        return empty_period()
+    with open(period_path(store, period, label), 'rb') as f:
+        return pickle.load(f)
+
+def update_period(store, period, label, settlement_id, end, aggregate, sign=1):
+    '''Adds a settlement aggregate to (or takes it out of) one stored period rollup'''
+    rollup = add_settlement(load_period(store, period, label), settlement_id, end, aggregate, sign)
+    if not rollup['settlements']:
+        if os.path.exists(period_path(store, period, label)):
+            os.remove(period_path(store, period, label))
+        return
+    os.makedirs(os.path.join(store, 'periods'), exist_ok=True)
+    temporary = period_path(store, period, label) + '.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump(rollup, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, period_path(store, period, label))
+
+def period_analysis(rollup):
+    '''Returns the main table (full column names) and overview of a period rollup, with the ratio columns recomputed
+    from the summed numerators and denominators'''
+    analysis = rollup['sums'].drop(columns='settlements')
+    units = [column for column in unit_columns + ['Total Units'] if column in analysis]
+    analysis[units] = np.rint(analysis[units]).astype(np.int64)
+    latest = [column for column in latest_columns if column in rollup['latest']]
+    if latest:
+        analysis = pd.concat([rollup['latest'][latest].reindex(analysis.index), analysis], axis=1)
+    analysis = add_ratio_columns(analysis)
+    analysis = analysis[[column for column in rollup['columns'] if column in analysis]]
+    analysis = analysis.sort_values('Total Profit' if 'Total Profit' in analysis else 'Total Return', ascending=False)
+    return analysis, rollup['overview']
+
+def get_rollup(store, period, label):
+    '''Returns the renamed main table, overview and settlement-ids (oldest first) of one stored period'''
+    rollup = load_period(store, period, label)
+    analysis, overview = period_analysis(rollup)
+    settlements = sorted(rollup['settlements'], key=lambda settlement_id: parse_settlement_date(rollup['settlements'][settlement_id]))
+    return rename_columns(analysis), overview, settlements
+
+def get_period_labels(store, period):
+    '''Returns every period label that has settlements, in order'''
+    return sorted({period_label(entry['end'], period) for entry in load_index(store).values()})
+
+def export_rollup(filename, store, period, formats=('xlsx',)):
+    '''Writes one Sales and one Overview tab per period. Returns the files written'''
+    tabs = {}
+    for label in get_period_labels(store, period):
+        main_df, overview, settlements = get_rollup(store, period, label)
+        tabs[label + ' Sales'] = main_df
+        tabs[label + ' Overview'] = overview
+    return write_report(filename, tabs, formats)
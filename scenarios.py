@@ -0,0 +1,104 @@
+'''What-if scenarios over a settlement's per-SKU totals.
+
+A scenario scales the selling price, product cost, packing cost and advertising spend of every SKU. The
+settlement is not read again: the per-SKU totals of the main table (from a run, or a settlement saved in the
+rollup store) are the base, and only the columns that depend on those inputs are recomputed: Total COGS, Total
+Return, Total Profit, ROI, ROI w/ advertising and Return/Unit. All scenarios are computed at once as scenario x SKU
+arrays. Units sold stay as they were; a price change scales sales revenue and commission together.
+
+Scenarios are described in a JSON file, a list of:
+    {"name": "Cost +10%", "product_cost": 1.1}
+    {"name": "Cheaper, more ads", "price": 0.95, "advertising": 1.5}
+Factors left out are 1. A scenario with lists of factors stands for every combination of them:
+    {"name": "Grid", "price": [0.9, 1.0, 1.1], "advertising": [0.5, 1, 2]}
+'''
+import itertools
+import json
+
+import numpy as np
+import pandas as pd
+
+from main import rename_columns, restore_column_names
+
+scenario_factors = ['price', 'product_cost', 'packing_cost', 'advertising']
+
+base_scenario = 'Current'
+
+def expand_scenario(scenario):
+    '''Returns the scenarios a scenario with lists of factors stands for, named after their factors'''
+    factors = {factor: scenario.get(factor, 1) for factor in scenario_factors}
+    listed = [factor for factor in scenario_factors if isinstance(factors[factor], list)]
+    if not listed:
+        return [dict(factors, name=scenario['name'])]
+    expanded = []
+    for values in itertools.product(*[factors[factor] for factor in listed]):
+        name = scenario['name'] + ' ' + ' '.join(factor + '=' + str(value) for factor, value in zip(listed, values))
+        expanded.append(dict(factors, name=name, **dict(zip(listed, values))))
+    return expanded
+
+def load_scenarios(path):
+    '''Reads a scenarios file. The unchanged Current scenario always comes first'''
+    with open(path) as f:
+        scenarios = json.load(f)
+    expanded = [dict({factor: 1 for factor in scenario_factors}, name=base_scenario)]
+    for scenario in scenarios:
+        expanded += expand_scenario(scenario)
+    return expanded
+
+def evaluate_scenarios(main_df, scenarios):
+    '''Returns the scenario x SKU arrays of the recomputed columns, keyed by their full column names'''
+    main_df = restore_column_names(main_df)
+    if 'Cost Per Unit' not in main_df:
+        raise ValueError('Scenarios need product costs, give the cost report (--cost)')
+    def column(name):
+        if name not in main_df:
+            return np.zeros(len(main_df))
+        return main_df[name].to_numpy(dtype=np.float64)
+    #one row per scenario, broadcast against one column per SKU
+    factors = {factor: np.array([[float(scenario[factor])] for scenario in scenarios]) for factor in scenario_factors}
+    total_units = column('Total Units')
+    advertising = column('Advertising Spend') * factors['advertising']
+    #added up in place to keep scenario x SKU temporaries few
+    total_return = (column('Sales Revenue') + column('Commission')) * (factors['price'] - 1)
+    total_return += advertising
+    total_return += column('Total Return') - column('Advertising Spend')
+    cost_per_unit = column('Product Cost') * factors['product_cost']
+    cost_per_unit += column('Packing Cost') * factors['packing_cost']
+    total_cost = cost_per_unit * (total_units * -1)
+    total_profit = total_cost + total_return
+    results = {
+        'Advertising Spend': advertising,
+        'Total Return': total_return,
+        'Cost Per Unit': cost_per_unit,
+        'Total Cost': total_cost,
+        'Total Profit': total_profit,
+    }
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['ROI'] = np.divide(total_profit, total_cost) * -1
+        if 'Advertising Spend' in main_df:
+            results['ROI w/ advertising'] = np.divide(total_profit, total_cost + advertising) * -1
+        results['Return Per Unit'] = np.divide(total_return, total_units)
+    for name in ['ROI', 'ROI w/ advertising', 'Return Per Unit']:
+        if name in results:
+            results[name][np.isinf(results[name])] = np.nan
+    return results
+
+def scenario_tabs(main_df, scenarios):
+    '''Returns a Scenarios tab (each scenario's factors and totals across SKUs, with the ratios recomputed from the
+    totals) and a Scenario Profit tab (Total Profit of each SKU under each scenario)'''
+    results = evaluate_scenarios(main_df, scenarios)
+    names = [scenario['name'] for scenario in scenarios]
+    total_units = restore_column_names(main_df)['Total Units'].to_numpy(dtype=np.float64).sum()
+    comparison = pd.DataFrame([{factor: scenario[factor] for factor in scenario_factors} for scenario in scenarios], index=pd.Index(names, name='scenario'))
+    for name in ['Advertising Spend', 'Total Return', 'Total Cost', 'Total Profit']:
+        comparison[name] = results[name].sum(axis=1)
+    if 'ROI w/ advertising' not in results:
+        del comparison['Advertising Spend']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        comparison['ROI'] = comparison['Total Profit'] / comparison['Total Cost'] * -1
+        if 'ROI w/ advertising' in results:
+            comparison['ROI w/ advertising'] = comparison['Total Profit'] / (comparison['Total Cost'] + comparison['Advertising Spend']) * -1
+        comparison['Return Per Unit'] = comparison['Total Return'] / total_units
+    comparison['Profit Change'] = comparison['Total Profit'] - comparison['Total Profit'].iloc[0]
+    profit = pd.DataFrame(results['Total Profit'].T, index=main_df.index, columns=names)
+    return {'Scenarios': rename_columns(comparison.replace([np.inf, -np.inf], np.nan)), 'Scenario Profit': profit}
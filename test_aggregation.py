@@ -0,0 +1,76 @@
+'''The report built from the single bucketed aggregation (get_sku_metrics) must match the one the original
+main_table built. test_data/baseline holds the Sales and Overview tabs the original main_table and get_overview
+wrote for test_data/settlement.txt, with and without storage charges, advertising and cost.
+
+    python -m pytest -q test_aggregation.py
+'''
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+def legacy_sku_metrics(settlement_df):
+    '''The SKU columns the way main_table used to put them together, one get_* helper per column'''
+    legacy = pd.concat([main.get_units_sold(settlement_df), main.get_nonsales_units(settlement_df),
+        main.get_merchantfulfilled_units(settlement_df), main.get_salesbased_revenue(settlement_df),
+        main.get_commission(settlement_df), main.get_fba_fees(settlement_df), main.get_nonsales_revenue(settlement_df)], axis=1)
+    #the helpers group by the categorical sku column, get_sku_metrics indexes by its categories
+    legacy.index = pd.Index(legacy.index.astype(object), name='sku')
+    #units come back as nullable Int64, where 0/0 is a NaN that fillna(0) leaves alone; get_sku_metrics gives int64
+    legacy[main.unit_columns] = legacy[main.unit_columns].astype(np.int64)
+    return legacy
+
+@pytest.fixture(scope='module')
+def reports():
+    def read(name, **options):
+        return pd.read_csv(os.path.join(test_data, name), **options)
+    return {
+        'settlement': read('settlement.txt', sep='\t', dtype=main.dtypes),
+        'fba_archive': read('fba_archive.csv', encoding='latin1'),
+        'storage': read('storage.csv', encoding='latin1'),
+        'lts': read('lts.csv', encoding='latin1'),
+        'advertising': read('advertising.csv'),
+        'cost': read('cost.csv'),
+    }
+
+def without_storage_charges(settlement_df):
+    return settlement_df.loc[~settlement_df['amount-description'].isin(['Storage Fee', 'StorageRenewalBilling'])]
+
+def read_baseline(case, tab):
+    return pd.read_csv(os.path.join(test_data, 'baseline', case + '_' + tab + '.csv'), index_col=0, dtype={'asin': str, 'Title': str})
+
+def test_sku_metrics_match_legacy_helpers(reports):
+    settlement_df = reports['settlement']
+    legacy = legacy_sku_metrics(settlement_df)
+    metrics = main.get_sku_metrics(settlement_df)
+    pd.testing.assert_frame_equal(metrics[legacy.columns], legacy, check_dtype=False, check_exact=False, rtol=1e-9)
+
+@pytest.mark.parametrize('storage, advertising, cost', list(itertools.product([True, False], repeat=3)))
+def test_report_matches_baseline_main_table(reports, storage, advertising, cost):
+    case = '_'.join(['storage' if storage else 'no-storage', 'advertising' if advertising else 'no-advertising', 'cost' if cost else 'no-cost'])
+    settlement_df = reports['settlement'] if storage else without_storage_charges(reports['settlement'])
+    tabs = main.analyze_settlement(settlement_df, reports['fba_archive'], reports['storage'], reports['lts'],
+        reports['advertising'] if advertising else None, reports['cost'] if cost else None)
+    sales = tabs['Sales'].copy()
+    #SKUs missing from the FBA archive get 0 for their asin and title
+    sales[['asin', 'Title']] = sales[['asin', 'Title']].astype(str)
+    baseline = read_baseline(case, 'Sales')
+    assert list(sales.columns) == list(baseline.columns)
+    #rows are sorted by a float total, SKUs with near-equal totals may swap places
+    pd.testing.assert_frame_equal(sales.sort_index(), baseline.sort_index(), check_dtype=False, check_exact=False, rtol=1e-9, check_names=False)
+    pd.testing.assert_frame_equal(tabs['Overview'], read_baseline(case, 'Overview'), check_dtype=False, check_exact=False, rtol=1e-9)
+
+def test_ratio_columns_match_legacy_helpers(reports):
+    settlement_df = reports['settlement']
+    sales = main.analyze_settlement(settlement_df, reports['fba_archive'])['Sales']
+    sold = sales.index[sales['Units Sold'] > 0]
+    for helper, column in [(main.get_average_sales_price, 'Avg Price'), (main.get_average_commision_per_unit, 'Comm/Unit'),
+            (main.get_average_fba_fees, 'Fee Avg'), (main.get_commission_percent, 'Comm %')]:
+        legacy = helper(settlement_df).reindex(sold).to_numpy(dtype=np.float64)
+        np.testing.assert_allclose(sales.loc[sold, column].to_numpy(dtype=np.float64), legacy, rtol=1e-9, err_msg=column)
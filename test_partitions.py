@@ -0,0 +1,49 @@
+'''An account split into marketplace partitions must add up to the report of the same settlement run whole.
+
+    python -m pytest -q test_partitions.py
+'''
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from partitions import analyze_account, combine_partition, partition_totals, rate_table, split_flat_file
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+#summed Sales columns of the whole settlement against the Total row of the Totals tab
+summed_sales_columns = ['Units Sold', 'Total', 'Sales Revenue', 'Comm', 'FBA Fees', 'N/S Rev', 'Amz Rev', 'Storage', 'Ad Spend',
+    'LTS Fee', 'Total Return', 'Total COGS', 'Total Profit']
+
+@pytest.fixture(scope='module')
+def account(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('account')
+    rows = pd.read_csv(os.path.join(test_data, 'settlement.txt'), sep='\t', dtype=str, keep_default_na=False)
+    #half of the orders are sold on Amazon.ca, in the same currency so no rate is needed
+    canadian = rows['order-id'].map(lambda order_id: order_id != '' and zlib.crc32(order_id.encode()) % 2 == 0)
+    rows.loc[canadian, 'marketplace-name'] = 'Amazon.ca'
+    flat_file = str(folder / 'settlement.txt')
+    rows.to_csv(flat_file, sep='\t', index=False)
+    advertising = str(folder / 'advertising.xlsx')
+    pd.read_csv(os.path.join(test_data, 'advertising.csv')).to_excel(advertising, index=False)
+    return {'account': 'Main', 'flat_files': [flat_file], 'fba_archive': os.path.join(test_data, 'fba_archive.csv'),
+        'storage': os.path.join(test_data, 'storage.csv'), 'lts': os.path.join(test_data, 'lts.csv'), 'advertising': advertising,
+        'cost': os.path.join(test_data, 'cost.csv')}
+
+def test_partition_totals_match_single_run(account):
+    flat_file = account['flat_files'][0]
+    partitions = {key: combine_partition([summary]) for key, summary in split_flat_file(flat_file, account['account']).items()}
+    assert sorted(key[1] for key in partitions) == ['Amazon.ca', 'Amazon.com']
+    totals, overview = partition_totals(analyze_account(account, partitions), rate_table({}, 'USD'))
+    single = main.analyze_settlement(pd.read_csv(flat_file, sep='\t', dtype=main.dtypes),
+        pd.read_csv(account['fba_archive'], encoding='latin1'), pd.read_csv(account['storage'], encoding='latin1'),
+        pd.read_csv(account['lts'], encoding='latin1'), pd.read_excel(account['advertising']), pd.read_csv(account['cost']))
+    expected = single['Sales'][summed_sales_columns].sum()
+    np.testing.assert_allclose(totals.loc['Total', summed_sales_columns].to_numpy(dtype=np.float64), expected.to_numpy(dtype=np.float64),
+        rtol=1e-9, err_msg=str(summed_sales_columns))
+    lines = ['Amazon Revenue', 'Storage Fee', 'Advertising Total']
+    np.testing.assert_allclose(overview.loc[lines, 'amount'].to_numpy(dtype=np.float64),
+        single['Overview'].loc[lines, 'amount'].to_numpy(dtype=np.float64), rtol=1e-9, err_msg=str(lines))
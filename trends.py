@@ -0,0 +1,154 @@
+'''Posted-date trends per SKU, inside a settlement and across settlements.
+
+posted-date is read as a category, so each distinct date is parsed once, with the format recognized on the first
+value, and every row gets its date through its category code. Rows are summed into (SKU, day or week) totals with
+one bincount per bucket, like get_sku_metrics. Rolling windows are differences of a running sum over each SKU's
+periods, so no per-SKU loop or date reindexing is needed. Each flat file is reduced on its own (in a process pool
+when there are several), so a year of settlements never sits in memory at once.
+'''
+import functools
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from main import (amount_cents, as_category, find_flat_files, read_settlement, revenue_bucket_codes, revenue_columns,
+    sum_by_sku_and_bucket, unit_bucket_codes, unit_columns)
+from report_writer import write_report
+
+trend_columns = ['sku', 'amount-description', 'fulfillment-id', 'amount', 'quantity-purchased', 'posted-date']
+
+#posted-date formats seen in flat files (US, EU, with time), tried in order on the first date of a file
+posted_date_formats = ['%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S UTC', '%Y-%m-%dT%H:%M:%S%z', '%d.%m.%Y %H:%M:%S UTC']
+
+period_days = {'day': 1, 'week': 7}
+default_windows = {'day': 7, 'week': 4}
+
+#summed per SKU and period, the rolling and per-unit columns are built from these
+trend_sums = ['Rows', 'Units Sold', 'Total Units'] + revenue_columns
+
+@functools.lru_cache(maxsize=None)
+def posted_date_format(shape):
+    '''Returns the strptime format of dates shaped like shape (digits replaced by 9), None to let pandas guess'''
+    sample = shape.replace('9', '1')
+    for date_format in posted_date_formats:
+        try:
+            datetime.strptime(sample, date_format)
+            return date_format
+        except ValueError:
+            continue
+    return None
+
+def parse_posted_dates(posted_date):
+    '''Returns the day number (days since 1970-01-01) of every row, -1 where there is no date. Only the distinct
+    dates are parsed'''
+    posted_date = as_category(posted_date)
+    categories = posted_date.cat.categories.astype(str)
+    if len(categories) == 0:
+        return np.full(len(posted_date), -1, dtype=np.int64)
+    date_format = posted_date_format(re.sub('[0-9]', '9', categories[0]))
+    dates = pd.to_datetime(categories, format=date_format, errors='coerce', utc=True)
+    days = np.asarray(dates.tz_localize(None).values.astype('datetime64[D]').astype(np.int64))
+    days[dates.isna()] = -1
+    #trailing slot so that a -1 (missing) code lands on "no date"
+    return np.append(days, -1)[posted_date.cat.codes.to_numpy()]
+
+def period_numbers(days, period):
+    '''Day numbers -> day or week numbers. Weeks start on Monday (1970-01-01 was a Thursday)'''
+    if period == 'week':
+        return np.where(days >= 0, (days + 3) // 7, -1)
+    return days
+
+def period_start(numbers, period):
+    if period == 'week':
+        numbers = numbers * 7 - 3
+    return numbers.astype('datetime64[D]')
+
+def sku_period_totals(settlement_df, period='day'):
+    '''Returns the trend_sums of every SKU and period that has rows, indexed by (sku, period start date).
+    Rows without a SKU or a posted date are left out'''
+    sku = as_category(settlement_df['sku'])
+    sku_codes = sku.cat.codes.to_numpy().astype(np.int64)
+    numbers = period_numbers(parse_posted_dates(settlement_df['posted-date']), period)
+    dated = (numbers >= 0) & (sku_codes >= 0)
+    if not dated.any():
+        return pd.DataFrame(columns=trend_sums, index=pd.MultiIndex.from_arrays([[], []], names=['sku', 'period']))
+    first = numbers[dated].min()
+    span = numbers[dated].max() - first + 1
+    #one dense (SKU, period) key per row, -1 for rows left out
+    keys = np.where(dated, sku_codes * span + (numbers - first), -1)
+    key_count = len(sku.cat.categories) * span
+    rows = np.bincount(keys[dated], minlength=key_count)
+    quantities = settlement_df['quantity-purchased'].fillna(0).to_numpy(dtype=np.float64)
+    units = sum_by_sku_and_bucket(keys, unit_bucket_codes(settlement_df), quantities, key_count, len(unit_columns))
+    revenue = sum_by_sku_and_bucket(keys, revenue_bucket_codes(settlement_df), amount_cents(settlement_df), key_count, len(revenue_columns)) / 100
+    present = np.flatnonzero(rows)
+    totals = pd.DataFrame(revenue[present], columns=revenue_columns)
+    totals.insert(0, 'Rows', rows[present])
+    totals.insert(1, 'Units Sold', np.rint(units[present, unit_columns.index('Units Sold')]).astype(np.int64))
+    totals.insert(2, 'Total Units', np.rint(units[present].sum(axis=1)).astype(np.int64))
+    totals.index = pd.MultiIndex.from_arrays([np.asarray(sku.cat.categories)[present // span],
+        period_start(first + present % span, period)], names=['sku', 'period'])
+    return totals
+
+def file_period_totals(flat_file, period='day'):
+    '''Reads the trend columns of one flat file (from the cache when it was read before) and returns its sku_period_totals'''
+    return sku_period_totals(read_settlement(flat_file, trend_columns), period)
+
+def add_rolling_columns(totals, period='day', window=None):
+    '''Adds the per-unit columns of each period and the units, revenue, fee per unit and return per unit over the
+    last window periods (calendar periods, so a SKU's quiet days count as zero). totals must be sorted by (sku, period)'''
+    window = window or default_windows[period]
+    step = period_days[period]
+    sku_codes = pd.factorize(totals.index.get_level_values('sku'))[0].astype(np.int64)
+    numbers = totals.index.get_level_values('period').values.astype('datetime64[D]').astype(np.int64) // step
+    span = numbers.max() - numbers.min() + window + 1 if len(numbers) else 1
+    keys = sku_codes * span + (numbers - numbers.min() + window)
+    #first row of the window of each row, never crossing into the previous SKU
+    starts = np.searchsorted(keys, keys - window + 1, 'left')
+    summed = ['Units Sold', 'Total Units', 'Sales Revenue', 'FBA Fees', 'Amazon Revenue']
+    trends = totals.copy()
+    trends['Amazon Revenue'] = trends[revenue_columns].sum(axis=1)
+    running = np.vstack([np.zeros(len(summed)), np.cumsum(trends[summed].to_numpy(dtype=np.float64), axis=0)])
+    rolling = running[np.arange(1, len(trends) + 1)] - running[starts]
+    rolling = pd.DataFrame(rolling, index=trends.index, columns=summed)
+    suffix = ' ({} {}s)'.format(window, period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trends['FBA Fee Average'] = trends['FBA Fees'] / trends['Units Sold']
+        trends['Return Per Unit'] = trends['Amazon Revenue'] / trends['Total Units']
+        trends['Units Sold' + suffix] = np.rint(rolling['Units Sold']).astype(np.int64)
+        trends['Sales Revenue' + suffix] = rolling['Sales Revenue']
+        trends['FBA Fee Average' + suffix] = rolling['FBA Fees'] / rolling['Units Sold']
+        trends['Return Per Unit' + suffix] = rolling['Amazon Revenue'] / rolling['Total Units']
+    return trends.replace([np.inf, -np.inf], np.nan)
+
+def trend_table(flat_files, period='day', window=None, workers=None):
+    '''Returns the trend of every SKU over the posted dates of the flat files (files or folders of flat files),
+    one row per SKU and day or week with rows, summed and rolling'''
+    paths = []
+    for entry in flat_files:
+        paths += find_flat_files(entry) if os.path.isdir(entry) else [entry]
+    if len(paths) > 1 and workers != 1:
+        parts = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(file_period_totals, path, period): path for path in paths}
+            for future, path in futures.items():
+                try:
+                    parts.append(future.result())
+                except Exception as error:
+                    print(path + ' failed: ' + repr(error), file=sys.stderr)
+    else:
+        parts = [file_period_totals(path, period) for path in paths]
+    if not parts:
+        raise ValueError('No flat file could be read from ' + ', '.join(flat_files))
+    totals = pd.concat(parts).groupby(level=['sku', 'period']).sum() if len(parts) > 1 else parts[0].sort_index()
+    return add_rolling_columns(totals, period, window)
+
+def export_trends(filename, trends, period='day', formats=('xlsx',)):
+    '''Writes the trend table as a Daily Trends or Weekly Trends tab (or file). Returns the files written'''
+    tab = ('Daily' if period == 'day' else 'Weekly') + ' Trends'
+    return write_report(filename, {tab: trends.reset_index(level='period')}, formats)
@@ -0,0 +1,228 @@
+'''Watch-folder mode: analyzes settlement flat files as they are dropped into a folder.
+
+Every poll lists the folder and classifies only the files it has not seen before (or that changed) by their
+header: flat file, FBA archive, monthly storage, LTS, advertising or cost report. What it learns (kind, statement
+period or report month) is kept in a small SQLite state file, so no file is read twice. Workbooks are opened in
+the worker pool, never in the polling loop. A new flat file is first summarized in the worker pool (statement
+period, storage and LTS charges, and the per-SKU totals the report is built from, which are handed to the report
+step so the flat file is read once), then matched with the newest FBA archive
+and cost report, the storage report of the month before its statement end date, the LTS report of its statement
+month and the advertising report that overlaps its statement period most, and queued for the report. A settlement
+charged for storage or LTS waits for that report for up to wait_minutes, then runs without it. At most `workers`
+files are inspected or analyzed at a time.
+'''
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+from main import is_flat_file, parse_settlement_date, read_settlement_summary, summary_lts_charged, summary_storage_charged
+
+#report kind -> columns its header must have, checked in order
+report_signatures = [
+    ('storage', {'fnsku', 'estimated_monthly_storage_fee'}),
+    ('lts', {'fnsku', 'amount-charged'}),
+    ('advertising', {'Advertised SKU', 'Spend'}),
+    ('cost', {'SKU', 'PRODUCT COST', 'SHIPPING COST'}),
+    ('fba-archive', {'sku', 'fnsku', 'asin'}),
+]
+
+state_schema = '''create table if not exists files (
+    path text primary key, size integer, mtime real, kind text, start text, end text,
+    storage_charged integer, lts_charged integer, status text, reports text, error text, seen real)'''
+
+def open_state(path):
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    connection.execute(state_schema)
+    connection.commit()
+    return connection
+
+def header_columns(path):
+    '''Returns the column names of a text report without reading its rows'''
+    with open(path, 'r', encoding='latin1') as f:
+        header = f.readline()
+    return {column.strip().strip('"') for column in re.split('[\t,]', header)}
+
+def classify(path):
+    '''Returns the kind of a file and the period it covers: (start, end) dates for flat files and advertising
+    reports, the month of charge for storage and LTS reports. (None, None, None) if it is not a report'''
+    if is_flat_file(path):
+        return 'settlement', None, None
+    workbook = None
+    try:
+        if path.lower().endswith('.xlsx'):
+            #advertising reports are the only workbooks and need their dates anyway, so the sheet is read once
+            workbook = pd.read_excel(path)
+            columns = set(workbook.columns)
+        else:
+            columns = header_columns(path)
+    except Exception:
+        return None, None, None
+    kind = next((kind for kind, required in report_signatures if required <= columns), None)
+    if kind == 'storage':
+        month = pd.read_csv(path, encoding='latin1', usecols=['month_of_charge'], nrows=1, dtype=str)
+        return kind, str(month.iloc[0, 0])[:7] if len(month) else None, None
+    if kind == 'lts' and 'snapshot-date' in columns:
+        snapshot = pd.read_csv(path, encoding='latin1', usecols=['snapshot-date'], nrows=1, dtype=str)
+        return kind, str(snapshot.iloc[0, 0])[:7] if len(snapshot) else None, None
+    if kind == 'advertising' and {'Start Date', 'End Date'} <= columns:
+        dates = workbook if workbook is not None else pd.read_excel(path, usecols=['Start Date', 'End Date'])
+        start = pd.to_datetime(dates['Start Date']).min()
+        end = pd.to_datetime(dates['End Date']).max()
+        return kind, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    return kind, None, None
+
+def scan(connection, folder, settle_seconds=10):
+    '''Records files that are new or changed since the last poll. Files written to in the last settle_seconds are
+    left for the next poll, they may still be downloading'''
+    known = {row['path']: row for row in connection.execute('select path, size, mtime from files')}
+    now = time.time()
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if now - stat.st_mtime < settle_seconds:
+            continue
+        row = known.get(path)
+        if row is not None and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+            continue
+        if path.lower().endswith('.xlsx'):
+            #classified in the worker pool (see watch)
+            kind, start, end, status = None, None, None, 'classifying'
+        else:
+            kind, start, end = classify(path)
+            status = 'new' if kind == 'settlement' else 'report'
+        connection.execute('insert or replace into files (path, size, mtime, kind, start, end, status, seen) values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime, kind, start, end, status, now))
+    connection.commit()
+
+def latest_report(connection, kind, where='', parameters=()):
+    row = connection.execute('select path from files where kind = ? ' + where + ' order by mtime desc limit 1', (kind,) + parameters).fetchone()
+    return row['path'] if row else None
+
+def days_between(start, end):
+    return (pd.Timestamp(end) - pd.Timestamp(start)).days
+
+def match_reports(connection, settlement):
+    '''Returns the reports for a flat file: newest FBA archive and cost report, storage report of the month before
+    the statement end date, LTS report of the statement start or end month, advertising report overlapping the
+    statement period most'''
+    start, end = [parse_settlement_date(settlement[key]).strftime('%Y-%m-%d') for key in ('start', 'end')]
+    storage_month = str(pd.Period(end, freq='M') - 1)
+    lts_months = (end[:7], start[:7])
+    reports = {
+        'fba-archive': latest_report(connection, 'fba-archive'),
+        'cost': latest_report(connection, 'cost'),
+        'storage': latest_report(connection, 'storage', 'and start = ?', (storage_month,)),
+        'lts': latest_report(connection, 'lts', 'and start in (?, ?)', lts_months),
+        'advertising': None,
+    }
+    best_overlap = 0
+    for row in connection.execute("select path, start, end from files where kind = 'advertising' and start is not null"):
+        overlap = days_between(max(start, row['start']), min(end, row['end']))
+        if overlap > best_overlap:
+            best_overlap = overlap
+            reports['advertising'] = row['path']
+    return reports
+
+def ready_to_run(settlement, reports, wait_minutes):
+    '''Returns True once the reports a settlement was charged for are there, or it has waited long enough'''
+    if reports['fba-archive'] is None:
+        return False
+    missing = (settlement['storage_charged'] and reports['storage'] is None) or (settlement['lts_charged'] and reports['lts'] is None)
+    return not missing or time.time() - settlement['seen'] > wait_minutes * 60
+
+def inspect_flat_file(flat_file, chunksize=None):
+    '''Worker side of the first step: streams the summary columns of a flat file once (read_settlement_summary).
+    The summary gives the statement period and storage/LTS charges, and is handed to the report step'''
+    return read_settlement_summary(flat_file, chunksize or 1000000)
+
+def watch(folder, output_folder, process, store=None, workers=2, interval=60, wait_minutes=60, state=None, once=False, **kwargs):
+    '''Polls folder every interval seconds and writes a report per new flat file into output_folder with
+    process(flat_file, fba_archive, output_prefix, storage_report=, lts_report=, advertising_report=, helium10=, **kwargs)
+    (cli.process_settlement, which also gets the summary= of the inspect step when this run made it). store(result), if
+    given, runs here after each report. once stops when nothing is left to do'''
+    os.makedirs(output_folder, exist_ok=True)
+    connection = open_state(state or os.path.join(folder, '.settlement_watch.sqlite'))
+    #files interrupted by a restart go back to where they were
+    connection.execute("update files set status = 'new' where status = 'inspecting'")
+    connection.execute("update files set status = 'waiting' where status = 'running'")
+    connection.commit()
+    running = {}
+    #flat file -> its summary from the inspect step, kept until its report is queued. After a restart the report
+    #step reads the flat file itself
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            scan(connection, folder)
+            for future in [future for future in running if future.done()]:
+                finish(connection, running.pop(future), future, store, summaries)
+            classifying = {path for step, path in running.values() if step == 'classify'}
+            for row in connection.execute("select path from files where status = 'classifying'").fetchall():
+                if len(running) >= workers:
+                    break
+                if row['path'] not in classifying:
+                    running[executor.submit(classify, row['path'])] = ('classify', row['path'])
+            #a workbook being classified may be the advertising report a settlement needs
+            pending = connection.execute("select 1 from files where status = 'classifying'").fetchone() is not None
+            for settlement in connection.execute("select * from files where kind = 'settlement' and status in ('new', 'waiting') order by mtime").fetchall():
+                if len(running) >= workers:
+                    break
+                path = settlement['path']
+                if settlement['status'] == 'new':
+                    running[executor.submit(inspect_flat_file, path, kwargs.get('chunksize'))] = ('inspect', path)
+                    connection.execute("update files set status = 'inspecting' where path = ?", (path,))
+                    continue
+                if pending:
+                    continue
+                reports = match_reports(connection, settlement)
+                if not ready_to_run(settlement, reports, wait_minutes):
+                    continue
+                prefix = os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0])
+                options = dict(kwargs, storage_report=reports['storage'], lts_report=reports['lts'], advertising_report=reports['advertising'], helium10=kwargs.get('helium10') or reports['cost'])
+                if path in summaries:
+                    options['summary'] = summaries.pop(path)
+                running[executor.submit(process, path, reports['fba-archive'], prefix, **options)] = ('process', path)
+                connection.execute("update files set status = 'running' where path = ?", (path,))
+            connection.commit()
+            if once and not running:
+                break
+            if running:
+                wait(list(running), timeout=interval, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(interval)
+    connection.close()
+
+def finish(connection, job, future, store, summaries):
+    '''Records the outcome of a classify, inspect or process job. Inspected summaries are kept in summaries'''
+    step, path = job
+    try:
+        result = future.result()
+    except Exception as error:
+        print(path + ' failed: ' + repr(error), file=sys.stderr)
+        connection.execute("update files set status = 'failed', error = ? where path = ?", (repr(error), path))
+        return
+    if step == 'classify':
+        kind, start, end = result
+        connection.execute("update files set status = 'report', kind = ?, start = ?, end = ? where path = ?", (kind, start, end, path))
+        return
+    if step == 'inspect':
+        statement_period = result['statement_period']
+        if statement_period is None:
+            connection.execute("update files set status = 'failed', error = 'no statement period' where path = ?", (path,))
+            return
+        connection.execute("update files set status = 'waiting', start = ?, end = ?, storage_charged = ?, lts_charged = ? where path = ?",
+            (statement_period[0], statement_period[1], int(summary_storage_charged(result)), int(summary_lts_charged(result)), path))
+        summaries[path] = result
+        return
+    if store is not None:
+        store(result)
+    connection.execute("update files set status = 'done', reports = ? where path = ?", (json.dumps(result['reports']), path))
+    print(path + ' -> ' + ', '.join(result['reports']))